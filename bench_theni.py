@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""Usage
+
+  bench_theni.py [options] [command ...]
+
+Benchmarks the ENI request pipeline of theni against a local file://
+repository, created with svnadmin in a temporary directory and filled with
+a generated project that uses every object type of theni.OBJECT_TYPES.
+
+Every command is measured end to end through EniHandler, and split into its
+phases as EniRequest runs them: parsing the request XML while it is fed,
+dispatch to the EniCmd_* class, the SvnDB work and rendering the response.
+Without arguments all commands are run.
+
+Options
+
+      --cache-size=MB   object cache of the SvnDB under test (default: 64)
+      --chunked         use chunked responses in EniHandler
+  -h, --help            show this help and exit
+  -i, --iterations=N    requests per command (default: 200)
+  -k, --keep            keep the temporary repository
+  -n, --objects=N       objects per object type (default: 20)
+      --objects-count   count the gc tracked objects a request leaves
+                        allocated (slow)
+  -r, --refresh=SECS    background refresh interval; 0 checks HEAD on every
+                        read (default: 5)
+  -s, --size=BYTES      size of an object; visualizations and boot
+                        projects are 16 times larger (default: 4096)
+  -t, --threads=N       svn clients of the SvnDB under test (default: 1)
+
+"""
+
+import base64
+import gc
+import getopt
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from StringIO import StringIO
+
+import pysvn
+import theni
+
+
+READ_COMMANDS = (
+        'get-server-settings',
+        'get-users',
+        'get-object-type-list',
+        'get-object-type',
+        'get-permissions',
+        'dir',
+        'dir-recursive',
+        'dir-folders',
+        'get-object',
+        'get-object-info',
+        'get-object-history',
+        )
+
+WRITE_COMMANDS = (
+        'check-out-object',
+        'check-in-object',
+        'create-object',
+        )
+
+LARGE_TYPES = ('vis', 'bop')
+
+
+class BenchFile(StringIO):
+    def close(self):
+        pass
+
+
+class BenchSocket:
+    """Just enough of a socket to run EniHandler on one request."""
+
+    def __init__(self, data):
+        self.rfile = BenchFile(data)
+        self.wfile = BenchFile()
+
+    def makefile(self, mode, bufsize = 0):
+        return self.rfile if 'r' in mode else self.wfile
+
+    def close(self):
+        pass
+
+
+class BenchServer:
+    server_name = 'localhost'
+    server_port = 80
+
+
+class Project:
+    """A generated project in a fresh local repository."""
+
+    def __init__(self, objects, size):
+        self.tmpdir = tempfile.mkdtemp(prefix='theni-bench-')
+        self.repos = os.path.join(self.tmpdir, 'repos')
+        self.wc = os.path.join(self.tmpdir, 'wc')
+        self.url = 'file://' + self.repos
+        self.objects = []
+
+        subprocess.check_call(['svnadmin', 'create', self.repos])
+        src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'Project'))
+        with open(os.path.join(src, 'enisvndb.conf'), 'w') as f:
+            f.write('[User]\nbench = Bench User,benchmark account\n')
+        for guid, ext, desc in theni.OBJECT_TYPES:
+            folder = os.path.join('Project', ext.upper())
+            os.makedirs(os.path.join(src, folder))
+            n = size * 16 if ext in LARGE_TYPES else size
+            for i in range(objects):
+                object_path = '%s/%s_%03d' % (folder, ext, i)
+                with open(os.path.join(src, '%s.%s' % (object_path, ext)), 'wb') as f:
+                    f.write(os.urandom(n))
+                self.objects.append((object_path, guid))
+
+        svn = pysvn.Client()
+        svn.import_(src, self.url, 'benchmark project')
+        svn.checkout(self.url, self.wc)
+
+    def remove(self):
+        shutil.rmtree(self.tmpdir)
+
+
+def request(command, fields = None, data = None):
+    fields = fields or {}
+    s = '<request command="%s" user-name="bench">' % command
+    s += '<%s>' % command
+    for k, v in fields.items():
+        s += '<%s>%s</%s>' % (k, v, k)
+    s += '</%s>' % command
+    if data is not None:
+        s += '<data>%s</data>' % base64.b64encode(data)
+    s += '</request>'
+    return s
+
+
+def requests(project, command, size):
+    """Yield an endless sequence of (before, body, after) for command.
+
+    Only body is measured, the requests in before and after set up and
+    clean up the repository around it.
+    """
+    objects = project.objects
+    n = 0
+    while True:
+        object_path, guid = objects[n % len(objects)]
+        fields = {'object-path' : object_path, 'object-type' : guid}
+        if command == 'get-object-type':
+            yield (), request(command, {'guid' : guid}), ()
+        elif command in ('dir', 'dir-recursive', 'dir-folders'):
+            yield (), request('dir', {
+                'root-path' : 'Project',
+                'recursive' : str(command != 'dir').lower(),
+                'folders-only' : str(command == 'dir-folders').lower(),
+                }), ()
+        elif command in ('get-object', 'get-object-info', 'get-object-history'):
+            yield (), request(command, fields), ()
+        elif command == 'check-out-object':
+            yield (), request(command, fields), (request('undo-check-out-object', fields),)
+        elif command == 'check-in-object':
+            check_out = request('check-out-object', fields)
+            fields['comment'] = 'benchmark check-in %d' % n
+            yield (check_out,), request(command, fields, os.urandom(size)), ()
+        elif command == 'create-object':
+            fields['object-path'] = 'Project/POU/new_%06d' % n
+            fields['object-type'] = theni.OBJECT_TYPES[0][0]
+            yield (), request(command, fields, os.urandom(size)), ()
+        else:
+            yield (), request(command), ()
+        n += 1
+
+
+def handle(body):
+    data = 'POST / HTTP/1.1\r\ncontent-length: %d\r\nconnection: close\r\n\r\n%s' % (
+            len(body), body)
+    sock = BenchSocket(data)
+    theni.EniHandler(sock, ('127.0.0.1', 0), BenchServer())
+    return sock.wfile.getvalue()
+
+
+def phases(body):
+    """Run one request phase by phase, return the duration of each phase."""
+    t0 = time.time()
+    eni = theni.EniRequest()
+    for i in xrange(0, len(body), theni.BLOCK_SIZE):
+        eni.feed(body[i:i + theni.BLOCK_SIZE])
+    t1 = time.time()
+    eni.parse()
+    t2 = time.time()
+    if eni.pending:
+        with theni.scheduler.slot(eni.req.priority, eni.req.user_name):
+            eni.execute()
+    t3 = time.time()
+    len(eni.response())
+    t4 = time.time()
+    return t1 - t0, t2 - t1, t3 - t2, t4 - t3
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench(project, command, iterations, size, count_objects):
+    bodies = requests(project, command, size)
+    latencies = []
+    parts = [[], [], [], []]
+    objects = 0
+    for i in range(iterations):
+        before, body, after = next(bodies)
+        map(handle, before)
+        if count_objects:
+            gc.collect()
+            live = len(gc.get_objects())
+        t = time.time()
+        response = handle(body)
+        latencies.append(time.time() - t)
+        if count_objects:
+            objects += len(gc.get_objects()) - live
+        map(handle, after)
+        if ' 200 ' not in response.split('\r\n', 1)[0] or '<error>' in response:
+            raise Exception('%s failed:\n%s' % (command, response))
+    elapsed = sum(latencies)
+
+    for i in range(min(iterations, 50)):
+        before, body, after = next(bodies)
+        map(handle, before)
+        for part, t in zip(parts, phases(body)):
+            part.append(t)
+        map(handle, after)
+
+    ms = lambda t: t * 1000.0
+    print '%-22s %8.1f %8.2f %8.2f %8.2f %8.3f %8.3f %8.2f %8.3f %8s' % (
+            command,
+            iterations / elapsed,
+            ms(percentile(latencies, 0.5)),
+            ms(percentile(latencies, 0.9)),
+            ms(percentile(latencies, 0.99)),
+            ms(percentile(parts[0], 0.5)),
+            ms(percentile(parts[1], 0.5)),
+            ms(percentile(parts[2], 0.5)),
+            ms(percentile(parts[3], 0.5)),
+            '%.0f' % (float(objects) / iterations) if count_objects else '-',
+            )
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hi:kn:r:s:t:', [
+            'cache-size=',
+            'chunked',
+            'help',
+            'iterations=',
+            'keep',
+            'objects=',
+            'objects-count',
+            'refresh=',
+            'size=',
+            'threads=',
+            ])
+    except getopt.GetoptError, err:
+        sys.exit('%s\n%s' % (err, __doc__))
+
+    cache_size = 64
+    iterations = 200
+    keep = False
+    objects = 20
+    count_objects = False
+    refresh = 5
+    size = 4096
+    threads = 1
+
+    for o, a in opts:
+        if o == '--cache-size':
+            cache_size = int(a)
+        elif o == '--chunked':
+            theni.EniHandler.chunked = True
+        elif o in ('-h', '--help'):
+            sys.exit(__doc__)
+        elif o in ('-i', '--iterations'):
+            iterations = int(a)
+        elif o in ('-k', '--keep'):
+            keep = True
+        elif o in ('-n', '--objects'):
+            objects = int(a)
+        elif o == '--objects-count':
+            count_objects = True
+        elif o in ('-r', '--refresh'):
+            refresh = float(a)
+        elif o in ('-s', '--size'):
+            size = int(a)
+        elif o in ('-t', '--threads'):
+            threads = int(a)
+
+    commands = args or READ_COMMANDS + WRITE_COMMANDS
+    for command in commands:
+        if command not in READ_COMMANDS + WRITE_COMMANDS:
+            sys.exit('Unknown command: %s' % command)
+
+    theni.logger.setLevel(logging.WARN)
+
+    project = Project(objects, size)
+    try:
+        theni.vcs = theni.SvnDB(project.wc, clients=threads,
+                cache_size=cache_size << 20, state_dir='')
+        for object_type in theni.OBJECT_TYPES:
+            theni.vcs.add_object_type_info(*object_type)
+        if refresh > 0:
+            theni.vcs.start_refresh(refresh)
+
+        print '%d objects, %d requests per command, %s' % (
+                len(project.objects), iterations, project.url)
+        print '%-22s %8s %8s %8s %8s %8s %8s %8s %8s %8s' % (
+                'command', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                'parse', 'dispatch', 'svndb', 'render', 'objs/req')
+        for command in commands:
+            bench(project, command, iterations, size, count_objects)
+    finally:
+        if keep:
+            print 'kept %s' % project.tmpdir
+        else:
+            project.remove()
+
+
+if __name__ == '__main__':
+    main()
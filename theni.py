@@ -4,24 +4,113 @@
 
   theni.py [options]
 
+Options
+
+      --admin-port=PORT serve /metrics (Prometheus text format) and /profile
+                        on PORT of localhost
+      --async           serve all connections from one event loop, running
+                        the requests on --threads worker threads; requests
+                        beyond 64 waiting per worker get a 503
+      --async-log       format and write log messages in a background thread
+  -b, --base=DIR        working copy (svn) or store directory (cas) of the
+                        database served at / (default: ../eni/, unless there
+                        are projects)
+      --bulk-limit=N    run at most N bulk commands (recursive dir and the
+                        histories) at a time
+  -c, --config=FILE     read the server configuration from FILE; its
+                        [projects] section has a NAME = DIR[,N] entry for
+                        every --project
+      --cache-size=MB   memory for cached object contents (default: 64)
+      --chunked         stream responses with chunked transfer encoding
+  -D, --db=NAME         database backend to use: svn, or cas for a local
+                        content-addressed store (default: svn)
+  -d, --debug           log debug messages
+      --direct          read from the repository URL at explicit revisions;
+                        the working copy only stages writes and may be a
+                        sparse checkout (svn checkout --depth empty)
+  -g, --group-commit=SECS
+                        commit check-ins of one user arriving within SECS
+                        seconds together
+  -h, --help            show this help and exit
+      --interactive-limit=N
+                        run at most N interactive commands at a time
+      --log-max-size=N  cut log messages to N characters; 0 keeps them
+                        whole (default: 4096)
+      --log-rate=N      log at most N debug and info messages per second
+                        of every kind
+      --log-sample=N    log only every Nth debug and info message of every
+                        kind
+      --max-history=N   return at most N versions of an object's history
+      --prefetch=N      after the first recursive dir of a connection, load
+                        the objects below into the cache; N threads per
+                        database serve all connections, as bulk work
+      --prefetch-budget=MB
+                        load at most MB per prefetch (default: 32)
+  -p, --processes=N     fork N worker processes sharing the listening socket,
+                        each with its own svn clients and caches; crashed
+                        workers are restarted
+      --profile-dir=DIR write request profiles to DIR (default: profiles)
+      --profile-every=N SIGUSR1 toggles profiling of every Nth request
+                        (default: 1)
+      --project=NAME=DIR[,N]
+                        also serve the working copy or store directory DIR
+                        at /NAME/, running at most N of its requests at a
+                        time (default: --threads); other paths go to --base
+      --queue-depth=N   refuse commands, with an error the client may retry,
+                        while N commands of the same user and class wait;
+                        waiting commands take turns by user
+  -r, --refresh=SECS    check for new revisions every SECS seconds in the
+                        background; 0 checks on every read (default: 5)
+      --state-dir=DIR   keep cached repository metadata in DIR, so a restart
+                        only catches up on new revisions; empty keeps it in
+                        memory only (default: .theni)
+  -t, --threads=N       handle requests concurrently, with up to N svn clients
+  -v, --verbose         log informational messages
 
 """
 
+import asynchat
+import asyncore
 import base64
+import bisect
 import codecs
+import collections
+import contextlib
+import cProfile
+import functools
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import getopt
 import getpass
+import hashlib
+import itertools
+import json
 import logging
 import os.path
+import pstats
 import pysvn
+import Queue
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
+import urllib
 import urlparse
 import sys
+import zlib
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from ConfigParser import ConfigParser
+from SocketServer import ThreadingMixIn
 from wsgiref.handlers import format_date_time
 from xml.etree import ElementTree as ET
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
 
 
 OBJECT_TYPES = (
@@ -49,175 +138,2211 @@ OBJECT_TYPES = (
 
 GUID_NULL = '{00000000-0000-0000-0000-000000000000}'
 
+NODE_DIR = 'dir'
+NODE_FILE = 'file'
+
+# object contents are moved in blocks of this size; a multiple of 3, so the
+# base64 encodings of consecutive blocks can simply be concatenated
+BLOCK_SIZE = 48 << 10
+SPOOL_SIZE = 1 << 20
+
+
+def object_checksum(blocks, crc = 0):
+    """The checksum of the content in blocks, as get-object compares it:
+    the CRC-32 in upper case hex."""
+    for block in blocks:
+        crc = zlib.crc32(block, crc)
+    return '%08X' % (crc & 0xffffffff)
+
+# seconds between checks of enisvndb.conf for changes
+CONFIG_CHECK_INTERVAL = 2
+
+# requests per worker the async front end queues, before it answers 503
+ASYNC_QUEUE_SIZE = 64
+
+# what get-server-settings tells the clients; the async front end closes
+# connections idle for longer than comm-timeout
+SERVER_SETTINGS = {
+    'comm-timeout' : 10, # seconds
+    'idle-interval' : 60, # seconds
+    'allow-anonymous' : 'true',
+    'client-expiration' : 2, # minutes
+    'max-trials' : 10,
+    'active-driver' : 'theni:svn',
+    }
+
+
+LOG_FORMAT = '%(levelname)s %(message)s'
 
 logger = logging.getLogger()
 
 logging.basicConfig(
         level=logging.INFO,
-        format='%(levelname)s %(message)s',
+        format=LOG_FORMAT,
         )
 
+
+class LogLimiter(logging.Filter):
+    """Samples and rate limits log records, per message template.
+
+    Of the debug and info records of one template, only every sample-th is
+    kept, and at most rate per second; warnings and errors always pass. The
+    next record let through tells how many were left out.
+    """
+
+    MAX_TEMPLATES = 10000
+
+    def __init__(self, rate = 0, sample = 1):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.sample = sample
+        self.__lock = threading.Lock()
+        self.__templates = {}   # msg -> [second, passed in second, seen, suppressed]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        second = int(record.created)
+        with self.__lock:
+            state = self.__templates.get(record.msg)
+            if state is None:
+                if len(self.__templates) >= self.MAX_TEMPLATES:
+                    self.__templates.clear()
+                state = self.__templates[record.msg] = [second, 0, 0, 0]
+            state[2] += 1
+            keep = self.sample <= 1 or state[2] % self.sample == 1
+            if keep and self.rate:
+                if state[0] != second:
+                    state[0], state[1] = second, 0
+                keep = state[1] < self.rate
+                state[1] += keep
+            if not keep:
+                state[3] += 1
+                return False
+            suppressed, state[3] = state[3], 0
+        if suppressed:
+            record.msg = '%s [%d similar suppressed]' % (record.msg, suppressed)
+        return True
+
+
+class LogFormatter(logging.Formatter):
+    """Cuts messages, such as whole requests, down to max_size characters."""
+
+    def __init__(self, fmt, max_size = 0):
+        logging.Formatter.__init__(self, fmt)
+        self.max_size = max_size
+
+    def format(self, record):
+        s = logging.Formatter.format(self, record)
+        if self.max_size and len(s) > self.max_size:
+            s = '%s... [%d characters]' % (s[:self.max_size], len(s))
+        return s
+
+
+class QueueLogHandler(logging.Handler):
+    """Passes records on to handlers in a background thread, so formatting
+    and writing them cost the request threads nothing.
+
+    Records are dropped while the queue is full.
+    """
+
+    def __init__(self, handlers, size = 10000):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.__queue = Queue.Queue(size)
+        thread = threading.Thread(target=self.__run, name='log')
+        thread.daemon = True
+        thread.start()
+
+    def emit(self, record):
+        try:
+            self.__queue.put_nowait(record)
+        except Queue.Full:
+            metrics.inc('theni_log_dropped_total')
+
+    def __run(self):
+        while True:
+            self.__handle(self.__queue.get())
+
+    def __handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        # logging.shutdown() at exit: write out what is left
+        while True:
+            try:
+                self.__handle(self.__queue.get_nowait())
+            except Queue.Empty:
+                break
+        logging.Handler.close(self)
+
+
+def setup_logging(async_log = False, rate = 0, sample = 1, max_size = 0):
+    if rate or sample > 1:
+        logger.addFilter(LogLimiter(rate, sample))
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        handler.setFormatter(LogFormatter(LOG_FORMAT, max_size))
+    if async_log:
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(QueueLogHandler(handlers))
+
 vcs = None
 
+# Project by name, '' being the project of --base
+projects = {}
+
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20)
+
+
+class Metrics:
+    """Counters, gauges and histograms in the Prometheus text format.
+
+    Labels are given as a tuple of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__types = {}
+        self.__values = collections.OrderedDict()
+        self.__collectors = []
+
+    def inc(self, name, labels = (), value = 1):
+        with self.__lock:
+            self.__types.setdefault(name, 'counter')
+            key = name, labels
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def add(self, name, value, labels = ()):
+        with self.__lock:
+            self.__types.setdefault(name, 'gauge')
+            key = name, labels
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def observe(self, name, value, labels = (), buckets = LATENCY_BUCKETS):
+        with self.__lock:
+            self.__types.setdefault(name, 'histogram')
+            key = name, labels
+            h = self.__values.get(key)
+            if h is None:
+                h = self.__values[key] = [buckets, [0] * len(buckets), 0, 0.0]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[1][i] += 1
+            h[2] += 1
+            h[3] += value
+
+    def add_collector(self, collect):
+        """collect() returns (name, type, labels, value) tuples at scrape time."""
+        self.__collectors.append(collect)
+
+    def render(self):
+        lines = []
+        with self.__lock:
+            values = self.__values.items()
+            types = dict(self.__types)
+        for collect in self.__collectors:
+            for name, type, labels, value in collect():
+                types.setdefault(name, type)
+                values.append(((name, labels), value))
+        seen = set()
+        for (name, labels), value in sorted(values, key=lambda v: v[0][0]):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s %s' % (name, types[name]))
+            if types[name] != 'histogram':
+                lines.append('%s%s %s' % (name, self.__labels(labels), value))
+                continue
+            buckets, counts, count, total = value
+            for le, n in zip(buckets, counts):
+                lines.append('%s_bucket%s %d' % (name, self.__labels(labels + (('le', le),)), n))
+            lines.append('%s_bucket%s %d' % (name, self.__labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, self.__labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self.__labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def __labels(self, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+
+
+metrics = Metrics()
+
+
+class RequestProfiler:
+    """Profiles every Nth ENI request, or every request of one command.
+
+    Stats are aggregated per command and written to <directory>/<command>.prof
+    after each profiled request. While disabled a request costs nothing but
+    the check of the enabled flag.
+    """
+
+    def __init__(self, directory = 'profiles'):
+        self.directory = directory
+        self.enabled = False
+        self.every = 0
+        self.command = None
+        self.__count = 0
+        self.__lock = threading.Lock()
+        self.__stats = {}
+
+    def configure(self, every = 0, command = None):
+        self.every = every
+        self.command = command
+        self.enabled = bool(every or command)
+        logger.warn('request profiling %s', self.status())
+
+    def toggle(self, every = 1):
+        if self.enabled:
+            self.configure()
+        else:
+            self.configure(every=every)
+
+    def status(self):
+        if self.command:
+            return 'of command %s into %s' % (self.command, self.directory)
+        if self.every:
+            return 'of every %d. request into %s' % (self.every, self.directory)
+        return 'disabled'
+
+    def wants(self):
+        """Decide whether to profile the next request, before its command is known."""
+        if self.command:
+            return True
+        with self.__lock:
+            self.__count += 1
+            return self.every > 0 and self.__count % self.every == 0
+
+    def call(self, f, command):
+        """Return f(), profiled if this request is to be; command() names
+        the ENI command once f has run."""
+        if not (self.enabled and self.wants()):
+            return f()
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f)
+        finally:
+            self.add(command(), profile)
 
-class SvnDB:
-    def __init__(self, base = '.'):
-        if not base.endswith('/'):
-            base += '/'
+    def add(self, command, profile):
+        if self.command and command != self.command:
+            return
+        with self.__lock:
+            stats = self.__stats.get(command)
+            if stats is None:
+                stats = self.__stats[command] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            stats.dump_stats(os.path.join(self.directory, '%s.prof' % command))
 
-        self.wcbase = base
-        self.svn = pysvn.Client()
+
+profiler = RequestProfiler()
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Scheduler:
+    """Admits ENI commands to the database by class, interactive or bulk.
+
+    At most limits[class] commands of a class run at the same time, 0 being
+    no limit. Waiting commands are admitted round robin by client, so a
+    burst of one client does not delay the others. A command finding depth
+    commands of its client and class waiting already is refused with
+    QueueFull, which only ever refuses the client causing the load.
+
+    slot waits in the calling thread; admit lets a command wait without
+    one, for the workers of the async server.
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.limits = {INTERACTIVE : 0, BULK : 0}
+        self.depth = 0
+        self.__running = {INTERACTIVE : 0, BULK : 0}
+        self.__waiting = {INTERACTIVE : 0, BULK : 0}
+        # client -> tickets, clients in the order of their turns
+        self.__queues = {INTERACTIVE : collections.OrderedDict(),
+                BULK : collections.OrderedDict()}
+        metrics.add_collector(self._collect_metrics)
+
+    def configure(self, interactive = 0, bulk = 0, depth = 0):
+        with self.__cond:
+            self.limits = {INTERACTIVE : interactive, BULK : bulk}
+            self.depth = depth
+        logger.info('scheduler: %d interactive, %d bulk, queue depth %d',
+                interactive, bulk, depth)
+
+    @contextlib.contextmanager
+    def slot(self, cls, client):
+        start = time.time()
+        with self.__cond:
+            ticket = self.__enqueue(cls, client, None)
+        if ticket is not None:
+            try:
+                with self.__cond:
+                    while not ticket[0]:
+                        self.__cond.wait()
+            except:
+                self.__cancel(cls, client, ticket)
+                raise
+        metrics.observe('theni_scheduler_wait_seconds', time.time() - start, (('class', cls),))
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    def admit(self, cls, client, resume):
+        """Return True if the command may run right away. Otherwise it
+        waits without a thread, resume() is called once it is admitted.
+        Either way the command calls release(cls) when done."""
+        start = time.time()
+        def admitted():
+            metrics.observe('theni_scheduler_wait_seconds', time.time() - start,
+                    (('class', cls),))
+            resume()
+        with self.__cond:
+            if self.__enqueue(cls, client, admitted) is not None:
+                return False
+        metrics.observe('theni_scheduler_wait_seconds', 0, (('class', cls),))
+        return True
+
+    def release(self, cls):
+        with self.__cond:
+            self.__running[cls] -= 1
+            resumes = self.__admit(cls)
+        self.__resume(resumes)
+
+    def __enqueue(self, cls, client, resume):
+        """Run the command or queue its ticket, which is returned."""
+        if not self.__waiting[cls] and self.__free(cls):
+            self.__running[cls] += 1
+            return None
+        queues = self.__queues[cls]
+        tickets = queues.get(client, ())
+        if self.depth and len(tickets) >= self.depth:
+            metrics.inc('theni_scheduler_rejected_total', (('class', cls),))
+            raise QueueFull('%d %s commands of %s waiting' % (len(tickets), cls, client))
+        ticket = [False, resume]
+        queues.setdefault(client, collections.deque()).append(ticket)
+        self.__waiting[cls] += 1
+        return ticket
+
+    def __cancel(self, cls, client, ticket):
+        with self.__cond:
+            if ticket[0]:
+                # admitted meanwhile, pass the slot on
+                self.__running[cls] -= 1
+                resumes = self.__admit(cls)
+            else:
+                # by identity, the tickets of a client all look alike
+                tickets = self.__queues[cls][client]
+                del tickets[[id(t) for t in tickets].index(id(ticket))]
+                if not tickets:
+                    del self.__queues[cls][client]
+                self.__waiting[cls] -= 1
+                resumes = ()
+        self.__resume(resumes)
+
+    def __free(self, cls):
+        return not self.limits[cls] or self.__running[cls] < self.limits[cls]
+
+    def __admit(self, cls):
+        """Admit waiting commands while there is room; return the resumes
+        of those without a thread, to be called outside the lock."""
+        queues = self.__queues[cls]
+        resumes = []
+        admitted = False
+        while queues and self.__free(cls):
+            client, tickets = queues.popitem(last=False)
+            ticket = tickets.popleft()
+            ticket[0] = True
+            if ticket[1] is not None:
+                resumes.append(ticket[1])
+            else:
+                admitted = True
+            if tickets:
+                # back in line behind the other clients
+                queues[client] = tickets
+            self.__waiting[cls] -= 1
+            self.__running[cls] += 1
+        if admitted:
+            self.__cond.notify_all()
+        return resumes
+
+    def __resume(self, resumes):
+        for resume in resumes:
+            try:
+                resume()
+            except Exception:
+                logger.exception('resuming a command failed')
+
+    def _collect_metrics(self):
+        with self.__cond:
+            return [('theni_scheduler_%s' % name, 'gauge', (('class', cls),), n)
+                    for name, counts in (('running', self.__running),
+                        ('waiting', self.__waiting))
+                    for cls, n in counts.items()]
+
+
+scheduler = Scheduler()
+
+
+def timed(f):
+    """Record the duration of every call of an SvnDB method."""
+    labels = (('method', f.__name__),)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            metrics.observe('theni_svn_seconds', time.time() - start, labels)
+    return wrapper
+
+
+class Base64Decoder:
+    """Decodes base64 text, fed in pieces of any size, into a file."""
+
+    def __init__(self, out):
+        self.out = out
+        self.__rest = ''
+
+    def feed(self, text):
+        text = self.__rest + ''.join(text.split()).encode('ascii')
+        n = len(text) & ~3
+        self.__rest = text[n:]
+        if n:
+            self.out.write(base64.b64decode(text[:n]))
+
+    def close(self):
+        if self.__rest:
+            self.out.write(base64.b64decode(self.__rest))
+            self.__rest = ''
+
+
+class EniTreeBuilder:
+    """Parser target building the tree of an ENI request, except for the
+    text of its <data> element.
+
+    That is decoded into a spooled temporary file as it is parsed, which is
+    attached to the element as payload; the tree only holds the small
+    command fields.
+    """
+
+    def __init__(self):
+        self.__builder = ET.TreeBuilder()
+        self.__depth = 0
+        self.__decoder = None
+
+    def start(self, tag, attrib):
+        elem = self.__builder.start(tag, attrib)
+        self.__depth += 1
+        if tag == 'data' and self.__depth == 2:
+            elem.payload = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            self.__decoder = Base64Decoder(elem.payload)
+        return elem
+
+    def data(self, text):
+        if self.__decoder is not None:
+            self.__decoder.feed(text)
+        else:
+            self.__builder.data(text)
+
+    def end(self, tag):
+        self.__depth -= 1
+        if self.__decoder is not None:
+            self.__decoder.close()
+            self.__decoder = None
+        return self.__builder.end(tag)
+
+    def close(self):
+        return self.__builder.close()
+
+
+def write_file(path, data):
+    """Replace the file at path with the contents of the file object data.
+
+    The content is written to a temporary file next to it first, so readers
+    never see a half written object.
+    """
+    fd, tmppath = tempfile.mkstemp(prefix='.theni-', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if data is not None:
+                data.seek(0)
+                shutil.copyfileobj(data, f, BLOCK_SIZE)
+        if os.path.exists(path):
+            # mkstemp creates the file readable for us only
+            shutil.copymode(path, tmppath)
+            if os.name == 'nt':
+                # nothing keeps working copy files open on nt, see
+                # SvnDB.open_object
+                os.remove(path)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+
+class CheckinGroup:
+    def __init__(self):
+        self.items = []
+        self.done = threading.Event()
+        self.rev = None
+        self.error = None
+
+
+class GroupCommitter:
+    """Collects the check-ins of one user arriving within window seconds
+    and commits them together.
+
+    Every caller blocks until the commit of its group is done, and sees its
+    outcome.
+    """
+
+    def __init__(self, db, window):
+        self.db = db
+        self.window = window
+        self.__lock = threading.Lock()
+        self.__groups = {}
+
+    def commit(self, user, wcpath, comment, unlock):
+        with self.__lock:
+            group = self.__groups.get(user)
+            if group is None:
+                group = self.__groups[user] = CheckinGroup()
+                timer = threading.Timer(self.window, self.__flush, (user, group))
+                timer.daemon = True
+                timer.start()
+            group.items.append((wcpath, comment, unlock))
+        group.done.wait()
+        if group.error is not None:
+            raise group.error
+        return group.rev
+
+    def __flush(self, user, group):
+        with self.__lock:
+            if self.__groups.get(user) is group:
+                del self.__groups[user]
+        try:
+            group.rev = self.db.commit_group(group.items)
+        except Exception, e:
+            logger.error('group check-in of %s failed: %s', user, str(e))
+            group.error = e
+        group.done.set()
+
+
+class SvnClientPool:
+    """Bounded pool of pysvn clients; a client is used by one thread at a time."""
+
+    def __init__(self, size = 1):
+        self.size = max(1, size)
+        self.__clients = Queue.Queue(self.size)
+        for i in range(self.size):
+            self.__clients.put(pysvn.Client())
+
+    @contextlib.contextmanager
+    def client(self):
+        svn = self.__clients.get()
+        try:
+            yield svn
+        finally:
+            self.__clients.put(svn)
+
+
+class RWLock:
+    """Shared/exclusive lock, waiting writers take precedence over new readers.
+
+    With a path, the lock also takes a shared or exclusive flock on that
+    file, so it holds against other processes too.
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+        self.__cond = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+
+    @contextlib.contextmanager
+    def __flock(self, operation):
+        if self.path is None:
+            yield
+            return
+        # one open file per holder, flocks of a shared file would merge
+        with open(self.path, 'a') as f:
+            fcntl.flock(f.fileno(), operation)
+            yield
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.__cond:
+            while self.__writer or self.__writers_waiting:
+                self.__cond.wait()
+            self.__readers += 1
+        try:
+            with self.__flock(fcntl.LOCK_SH if fcntl else None):
+                yield
+        finally:
+            with self.__cond:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.__cond:
+            self.__writers_waiting += 1
+            while self.__writer or self.__readers:
+                self.__cond.wait()
+            self.__writers_waiting -= 1
+            self.__writer = True
+        try:
+            with self.__flock(fcntl.LOCK_EX if fcntl else None):
+                yield
+        finally:
+            with self.__cond:
+                self.__writer = False
+                self.__cond.notify_all()
+
+
+class PathLocks:
+    """One lock per path, created on demand and dropped when unused.
+
+    With a directory, a path is also locked against other processes, with
+    a flock on a file in directory named by the SHA-1 of the path.
+    """
+
+    def __init__(self, directory = None):
+        self.directory = directory
+        self.__guard = threading.Lock()
+        self.__locks = {}
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @contextlib.contextmanager
+    def hold(self, path):
+        with self.__guard:
+            lock, users = self.__locks.get(path, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.__locks[path] = lock, users + 1
+        lock.acquire()
+        try:
+            if self.directory is None:
+                yield
+            else:
+                name = hashlib.sha1(path.encode('utf8') if isinstance(path, unicode) else path)
+                with open(os.path.join(self.directory, name.hexdigest()), 'a') as f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                    yield
+        finally:
+            lock.release()
+            with self.__guard:
+                lock, users = self.__locks[path]
+                if users > 1:
+                    self.__locks[path] = lock, users - 1
+                else:
+                    del self.__locks[path]
+
+
+class ObjectCache:
+    """Object contents keyed by (object path, object type, revision).
+
+    Contents at a fixed revision never change, so entries are only dropped
+    to stay within max_bytes, least recently used first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.__lock:
+            content = self.__entries.pop(key, None)
+            if content is None:
+                self.misses += 1
+                return None
+            self.__entries[key] = content
+            self.hits += 1
+            return content
+
+    def put(self, key, content):
+        if len(content) > self.max_entry:
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.__entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                key, old = self.__entries.popitem(last=False)
+                self.size -= len(old)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def invalidate(self, object_path, object_type):
+        with self.__lock:
+            for key in self.__entries.keys():
+                if key[:2] == (object_path, object_type):
+                    self.size -= len(self.__entries.pop(key))
+
+    def stats(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'entries' : len(self.__entries),
+            'bytes' : self.size,
+            }
+
+
+class Prefetch:
+    """Loads objects into the cache of a database in the background.
+
+    The workers of executor, shared by all prefetches of the database,
+    fetch the objects one by one, until all are cached, budget bytes were
+    fetched or the prefetch is cancelled. Every fetch is bulk work of user
+    for the scheduler.
+    """
+
+    def __init__(self, db, objects, executor, budget, user):
+        self.db = db
+        self.budget = budget
+        self.user = user
+        self.fetched = 0
+        self.count = 0
+        self.__objects = Queue.Queue()
+        for key in objects:
+            self.__objects.put(key)
+        self.__cancelled = threading.Event()
+        self.__lock = threading.Lock()
+        self.__running = executor.workers
+        for i in range(executor.workers):
+            executor.submit(self.__run)
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def __run(self):
+        try:
+            self.__fetch()
+        except Exception:
+            # anything but a missing object stops this worker, not silently
+            logger.exception('prefetch failed')
+        with self.__lock:
+            self.__running -= 1
+            if self.__running:
+                return
+        logger.info('prefetched %d objects, %d bytes%s', self.count, self.fetched,
+                ' (cancelled)' if self.__cancelled.is_set() else '')
+
+    def __fetch(self):
+        while not self.__cancelled.is_set() and self.fetched < self.budget:
+            try:
+                key = self.__objects.get_nowait()
+            except Queue.Empty:
+                break
+            if key in self.db.cache:
+                continue
+            try:
+                with scheduler.slot(BULK, self.user):
+                    content = self.db.cat(*key)
+            except pysvn.ClientError, e:
+                logger.warn('prefetch of %s failed: %s', key[0], str(e))
+                continue
+            except QueueFull, e:
+                # the requests of the user come first
+                logger.info('prefetch stopped: %s', e)
+                break
+            with self.__lock:
+                self.fetched += len(content)
+                self.count += 1
+            metrics.inc('theni_prefetch_bytes_total', value=len(content))
+
+
+TreeNode = collections.namedtuple('TreeNode', 'kind object_type rev date')
+
+
+def split_path(path):
+    i = path.rfind('/')
+    return (path[:i], path[i + 1:]) if i >= 0 else ('', path)
+
+
+class Tree:
+    """Folders and objects by path, '' being the root folder."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def ls(self, path, recursive, folders_only):
+        path = path.strip('/')
+        with self.lock:
+            node = self.nodes.get(path)
+            if node is None:
+                raise Exception('path "%s" not found' % path)
+            if node.kind == NODE_FILE:
+                entries = [(path, node)]
+            else:
+                entries = []
+                self.__walk(path, recursive, entries)
+        if folders_only:
+            entries = [e for e in entries if e[1].kind == NODE_DIR]
+        return entries
+
+    def __walk(self, path, recursive, entries):
+        for name in sorted(self.children.get(path, ())):
+            child = path + '/' + name if path else name
+            node = self.nodes[child]
+            entries.append((child, node))
+            if recursive and node.kind == NODE_DIR:
+                self.__walk(child, recursive, entries)
+
+    def add(self, path, node):
+        if node.kind == NODE_DIR:
+            self.children.setdefault(path, set())
+        self.nodes[path] = node
+        if path:
+            parent, name = split_path(path)
+            self.children.setdefault(parent, set()).add(name)
+
+    def remove(self, path):
+        for name in self.children.pop(path, ()):
+            self.remove(path + '/' + name if path else name)
+        self.nodes.pop(path, None)
+        if path:
+            parent, name = split_path(path)
+            self.children.get(parent, set()).discard(name)
+
+    def touch(self, path, rev, date):
+        """Record a change of path in rev, which changes its folders too."""
+        while True:
+            node = self.nodes.get(path)
+            if node is not None:
+                self.nodes[path] = node._replace(rev=rev, date=date)
+            if not path:
+                break
+            path = split_path(path)[0]
+
+
+class TreeIndex(Tree):
+    """Folders and objects below the repository URL of the working copy.
+
+    Built from one recursive svn list, then kept current by replaying the
+    changed paths of every new revision from svn log. Every change is
+    written through to the MetaStore, so a restart only replays the
+    revisions committed since.
+    """
+
+    DIRENT_FIELDS = (pysvn.SVN_DIRENT_KIND | pysvn.SVN_DIRENT_CREATED_REV |
+            pysvn.SVN_DIRENT_TIME)
+
+    def __init__(self, db, url, repos_path):
+        Tree.__init__(self)
+        self.db = db
+        self.url = url
+        self.repos_path = repos_path.rstrip('/')
+        self.rev = None
+        self.__dirty = set()
+
+    def load(self, head):
+        """Start from the tree stored in the MetaStore, unless it is from
+        after revision head."""
+        rev, nodes = self.db.meta.tree(self.repos_path)
+        if rev is None:
+            return
+        if rev > head:
+            logger.warn('ignoring stored tree index r%s, HEAD is r%s', rev, head)
+            return
+        with self.lock:
+            for path, node in nodes:
+                Tree.add(self, path, node)
+            self.rev = rev
+        logger.info('loaded tree index r%s, %d nodes', rev, len(self.nodes))
+
+    def sync(self, svn, rev):
+        with self.lock:
+            rebuild = self.rev is None
+            if rebuild:
+                logger.info('building tree index of %s@%s', self.url, rev)
+                self.__list(svn, self.url, rev, True)
+            elif rev > self.rev:
+                logger.info('updating tree index r%s:%s', self.rev + 1, rev)
+                for entry in svn.log(self.url,
+                        revision_start=self.__rev(self.rev + 1),
+                        revision_end=self.__rev(rev),
+                        peg_revision=self.__rev(rev),
+                        discover_changed_paths=True):
+                    self.__replay(svn, entry)
+            else:
+                return
+            self.rev = rev
+            self.db.meta.update_tree(self.repos_path, rev,
+                    [(path, self.nodes.get(path)) for path in self.__dirty], rebuild)
+            self.__dirty.clear()
+            logger.info('tree index at r%s, %d nodes', rev, len(self.nodes))
+
+    def add(self, path, node):
+        Tree.add(self, path, node)
+        self.__dirty.add(path)
+
+    def remove(self, path):
+        Tree.remove(self, path)
+        self.__dirty.add(path)
+
+    def touch(self, path, rev, date):
+        Tree.touch(self, path, rev, date)
+        while path:
+            self.__dirty.add(path)
+            path = split_path(path)[0]
+        self.__dirty.add('')
+
+    def __replay(self, svn, entry):
+        rev = entry.revision.number
+        for change in sorted(entry.changed_paths, key=lambda c: c.path):
+            path = self.relpath(change.path)
+            if path is None:
+                continue
+            if change.action in ('D', 'R'):
+                self.remove(path)
+            if change.action in ('A', 'R'):
+                # copies bring their whole subtree along
+                self.__list(svn, self.__url(path), rev,
+                        change.copyfrom_path is not None)
+            if path not in self.nodes:
+                path = split_path(path)[0]
+            self.touch(path, rev, entry.date)
+
+    def __list(self, svn, url, rev, recurse):
+        for dirent, lock in svn.list(url,
+                peg_revision=self.__rev(rev),
+                revision=self.__rev(rev),
+                recurse=recurse,
+                dirent_fields=self.DIRENT_FIELDS):
+            path = self.relpath(dirent.repos_path)
+            if path is None:
+                continue
+            rev, date = dirent.created_rev.number, dirent.time
+            if dirent.kind == pysvn.node_kind.dir:
+                self.add(path, TreeNode(NODE_DIR, None, rev, date))
+            else:
+                object_type = self.db.get_object_type(os.path.splitext(path)[1])
+                self.add(path, TreeNode(NODE_FILE, object_type, rev, date))
+
+    def relpath(self, repos_path):
+        """Path of repos_path in the tree, None if it is outside."""
+        repos_path = repos_path.rstrip('/')
+        if repos_path == self.repos_path:
+            return ''
+        if repos_path.startswith(self.repos_path + '/'):
+            return repos_path[len(self.repos_path) + 1:]
+        return None
+
+    def __url(self, path):
+        return '%s/%s' % (self.url, urllib.quote(path.encode('utf8')))
+
+    def __rev(self, rev):
+        return pysvn.Revision(pysvn.opt_revision_kind.number, rev)
+
+
+HistoryEntry = collections.namedtuple('HistoryEntry', 'rev author date message label')
+
+
+class MetaStore:
+    """Metadata derived from the repository, kept in SQLite across restarts.
+
+    Everything is keyed by the repository UUID, so a state file never
+    mixes up two repositories.
+    """
+
+    SCHEMA = '''
+        create table if not exists history (
+            uuid text, path text, rev integer,
+            author text, date real, message text,
+            primary key (uuid, path, rev));
+        create table if not exists history_rev (
+            uuid text, path text, rev integer,
+            primary key (uuid, path));
+        create table if not exists labels (
+            uuid text, rev integer, label text,
+            primary key (uuid, rev));
+        create index if not exists labels_label on labels (uuid, label);
+        create table if not exists labels_rev (
+            uuid text primary key, rev integer);
+        create table if not exists checksums (
+            uuid text, path text, rev integer, checksum text,
+            primary key (uuid, path, rev));
+        create table if not exists tree (
+            uuid text, root text, path text,
+            kind text, object_type text, rev integer, date real,
+            primary key (uuid, root, path));
+        create table if not exists tree_rev (
+            uuid text, root text, rev integer,
+            primary key (uuid, root));
+        create table if not exists wc_rev (
+            uuid text, wcbase text, rev integer,
+            primary key (uuid, wcbase));
+        '''
+
+    def __init__(self, filename, uuid):
+        self.filename = filename
+        self.uuid = uuid
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.executescript(self.SCHEMA)
+
+    def history(self, path, limit = 0):
+        """Return the revision the history of path is complete up to, and
+        its entries, newest first."""
+        with self.__lock:
+            row = self.__db.execute(
+                    'select rev from history_rev where uuid = ? and path = ?',
+                    (self.uuid, path)).fetchone()
+            entries = self.__db.execute('''
+                    select h.rev, h.author, h.date, h.message, l.label
+                    from history h left join labels l
+                        on l.uuid = h.uuid and l.rev = h.rev
+                    where h.uuid = ? and h.path = ?
+                    order by h.rev desc limit ?''',
+                    (self.uuid, path, limit or -1)).fetchall()
+        return row[0] if row else 0, [HistoryEntry(*e) for e in entries]
+
+    def add_history(self, path, rev, entries):
+        with self.__lock:
+            with self.__db:
+                self.__db.executemany(
+                        'insert or replace into history values (?, ?, ?, ?, ?, ?)',
+                        [(self.uuid, path, e.rev, e.author, e.date, e.message)
+                            for e in entries])
+                self.__db.executemany(
+                        'insert or replace into labels values (?, ?, ?)',
+                        [(self.uuid, e.rev, e.label) for e in entries if e.label])
+                self.__db.execute(
+                        'insert or replace into history_rev values (?, ?, ?)',
+                        (self.uuid, path, rev))
+
+    def labels_rev(self):
+        """Return the revision the label index is complete up to."""
+        with self.__lock:
+            row = self.__db.execute(
+                    'select rev from labels_rev where uuid = ?',
+                    (self.uuid,)).fetchone()
+        return row[0] if row else 0
+
+    def add_labels(self, rev, labels):
+        """Add (rev, label) pairs, found in the revisions up to rev."""
+        with self.__lock:
+            with self.__db:
+                self.__db.executemany(
+                        'insert or replace into labels values (?, ?, ?)',
+                        [(self.uuid, r, label) for r, label in labels])
+                self.__db.execute(
+                        'insert or replace into labels_rev values (?, ?)',
+                        (self.uuid, rev))
+
+    def find_label(self, label):
+        """Return the newest revision labelled label, or None."""
+        with self.__lock:
+            return self.__db.execute(
+                    'select max(rev) from labels where uuid = ? and label = ?',
+                    (self.uuid, label)).fetchone()[0]
+
+    def set_label(self, rev, label):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute(
+                        'insert or replace into labels values (?, ?, ?)',
+                        (self.uuid, rev, label))
+
+    def checksum(self, path, rev):
+        with self.__lock:
+            row = self.__db.execute(
+                    'select checksum from checksums where uuid = ? and path = ? and rev = ?',
+                    (self.uuid, path, rev)).fetchone()
+        return row[0] if row else None
+
+    def add_checksum(self, path, rev, checksum):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute(
+                        'insert or replace into checksums values (?, ?, ?, ?)',
+                        (self.uuid, path, rev, checksum))
+
+    def tree(self, root):
+        """Return the revision the tree below the repository path root was
+        stored at, None if there is none, and its (path, TreeNode)s."""
+        with self.__lock:
+            row = self.__db.execute(
+                    'select rev from tree_rev where uuid = ? and root = ?',
+                    (self.uuid, root)).fetchone()
+            if row is None:
+                return None, []
+            nodes = self.__db.execute('''
+                    select path, kind, object_type, rev, date from tree
+                    where uuid = ? and root = ?''',
+                    (self.uuid, root)).fetchall()
+        return row[0], [(n[0], TreeNode(*n[1:])) for n in nodes]
+
+    def update_tree(self, root, rev, nodes, replace = False):
+        """Store the (path, TreeNode)s changed up to rev, a node of None
+        removes its path."""
+        with self.__lock:
+            with self.__db:
+                if replace:
+                    self.__db.execute('delete from tree where uuid = ? and root = ?',
+                            (self.uuid, root))
+                self.__db.executemany(
+                        'delete from tree where uuid = ? and root = ? and path = ?',
+                        [(self.uuid, root, path) for path, node in nodes if node is None])
+                self.__db.executemany(
+                        'insert or replace into tree values (?, ?, ?, ?, ?, ?, ?)',
+                        [(self.uuid, root, path) + tuple(node)
+                            for path, node in nodes if node is not None])
+                self.__db.execute(
+                        'insert or replace into tree_rev values (?, ?, ?)',
+                        (self.uuid, root, rev))
+
+    def wc_rev(self, wcbase):
+        """Return the revision wcbase was last updated to, or 0."""
+        with self.__lock:
+            row = self.__db.execute(
+                    'select rev from wc_rev where uuid = ? and wcbase = ?',
+                    (self.uuid, wcbase)).fetchone()
+        return row[0] if row else 0
+
+    def set_wc_rev(self, wcbase, rev):
+        with self.__lock:
+            with self.__db:
+                self.__db.execute(
+                        'insert or replace into wc_rev values (?, ?, ?)',
+                        (self.uuid, wcbase, rev))
+
+
+class WcRefresher(threading.Thread):
+    """Brings the working copy up to date whenever the repository HEAD moved."""
+
+    def __init__(self, db, interval):
+        threading.Thread.__init__(self, name='wc-refresh')
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+        self.__stop = threading.Event()
+
+    def run(self):
+        logger.info('refreshing working copy every %s seconds', self.interval)
+        while not self.__stop.wait(self.interval):
+            try:
+                self.db.refresh_wc()
+            except pysvn.ClientError, e:
+                logger.warn('working copy refresh failed: %s', str(e))
+            except Exception:
+                # the thread must live on, reads of HEAD rely on it
+                logger.exception('working copy refresh failed')
+
+    def stop(self):
+        self.__stop.set()
+
+
+ObjectInfo = collections.namedtuple('ObjectInfo', 'kind rev date lock')
+LockInfo = collections.namedtuple('LockInfo', 'owner comment')
+
+
+class DBError(Exception):
+    """A request the database backend refuses, e.g. locking a locked object."""
+
+
+class ConfigWatcher(threading.Thread):
+    """Re-reads the configuration file of a database whenever it changes."""
+
+    def __init__(self, db, interval):
+        threading.Thread.__init__(self, name='config-watch')
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.db.reload_config()
+            except Exception, e:
+                logger.error('reading "%s" failed, keeping the old configuration: %s',
+                        self.db.conf, str(e))
+
+
+class BaseDB:
+    """Object types and users, common to all database backends.
+
+    Responses that only depend on these are rendered once and kept until
+    the configuration changes.
+    """
+
+    def __init__(self):
         self.object_type_db1 = {}
         self.object_type_db2 = {}
         self.users = {}
+        self.conf = None
+        self.conf_stat = None
+        self.metric_labels = ()
+        self.__responses = {}
+
+    def load_config(self, conf):
+        self.conf = conf
+        self.reload_config()
+
+    def reload_config(self):
+        """Read the configuration file, unless it is unchanged since the
+        last time."""
+        try:
+            st = os.stat(self.conf)
+        except OSError:
+            return
+        if (st.st_mtime, st.st_size) == self.conf_stat:
+            return
+        # a broken file is reported once, not on every check
+        self.conf_stat = st.st_mtime, st.st_size
+        logger.info('reading theni:svn config from "%s"', self.conf)
+        config = ConfigParser()
+        config.readfp(codecs.open(self.conf, 'r', 'utf8'))
+        users = {}
+        for login, v in config.items('User'):
+            fullname, info = v.split(',')
+            logger.info(' added user %s, %s, %s', login, fullname, info)
+            users[login] = fullname, info
+        self.users = users
+        self._changed()
+
+    def prefetch(self, path, user):
+        """Start loading the objects below path into memory for user,
+        return the Prefetch or None."""
+        return None
+
+    def checksum(self, object_path, object_type, rev):
+        """Return the object_checksum() of an object as it was changed in
+        revision rev, or None if it is not known yet."""
+        return None
+
+    def add_checksum(self, object_path, object_type, rev, checksum):
+        pass
+
+    def watch_config(self, interval):
+        if self.conf is not None:
+            ConfigWatcher(self, interval).start()
+
+    def static_response(self, key, render):
+        """Return the encoded response for key, rendering it with render()
+        only once per configuration."""
+        responses = self.__responses
+        content = responses.get(key)
+        if content is None:
+            # a response rendered while the configuration changes ends up
+            # in the dictionary being dropped
+            content = responses[key] = render()
+        return content
+
+    def _changed(self):
+        self.__responses = {}
+
+    def add_object_type_info(self, guid, ext, desc):
+        logger.info('add object type: %s .%-3s "%s"', guid, ext, desc)
+        self.object_type_db1[guid] = (desc, ext)
+        self.object_type_db2[ext] = guid
+        self._changed()
+
+    def get_object_type_info(self, object_type):
+        return self.object_type_db1.get(object_type, ('', ''))
+
+    def get_object_type(self, ext):
+        ext = ext[1:] if ext.startswith('.') else ext
+        return self.object_type_db2.get(ext, GUID_NULL)
+
+    def get_object_types(self):
+        return self.object_type_db1.keys()
+
+    def _get_object_ext(self, object_type):
+        desc, ext = self.get_object_type_info(object_type)
+        return '.%s' % ext if ext else ''
+
+    def _path(self, object_path, object_type = None):
+        return (object_path + self._get_object_ext(object_type)).strip('/')
+
 
-        info = self.info('')
+class SvnDB(BaseDB):
+    """Objects in a Subversion repository, written through a working copy.
+
+    In direct mode reads go to the repository URL at explicit revisions and
+    the working copy only stages writes, so it can be a sparse checkout
+    (svn checkout --depth empty) that is filled on demand.
+    """
+
+    def __init__(self, base = '.', clients = 1, cache_size = 64 << 20,
+            state_dir = None, max_history = 0, group_commit = 0, direct = False,
+            shared_wc = False, prefetch_workers = 0, prefetch_budget = 32 << 20):
+        BaseDB.__init__(self)
+        if not base.endswith('/'):
+            base += '/'
+
+        self.wcbase = base
+        self.direct = direct
+        self.clients = SvnClientPool(clients)
+        self.cache = ObjectCache(cache_size)
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_budget = min(prefetch_budget, cache_size)
+        # all prefetches share these, however many connections start one
+        self.prefetcher = Executor(prefetch_workers, 'prefetch') if prefetch_workers else None
+
+        # svn update needs the whole working copy, everything else runs
+        # shared. svn locks the folders it changes, so only one write runs
+        # at a time, and writes are serialized per object path for as long
+        # as a check-in takes. A working copy shared with other processes
+        # is locked for them too.
+        svndir = os.path.join(base, '.svn')
+        self.wc_lock = RWLock(os.path.join(svndir, 'theni.lock') if shared_wc else None)
+        self.write_lock = RWLock(os.path.join(svndir, 'theni-write.lock') if shared_wc else None)
+        self.path_locks = PathLocks(os.path.join(svndir, 'theni-paths') if shared_wc else None)
+        self.group_commit = GroupCommitter(self, group_commit) if group_commit > 0 else None
+
+        self.wc_rev = 0
+        self.refresher = None
+        with self.clients.client() as svn:
+            info = svn.info2(self.wcbase, recurse=False)[0][1]
+        self.url = info.URL
+        self.root_url = info.repos_root_URL
+        self.commit_rev = 0
+
+        self.max_history = max_history
+        if state_dir:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            self.meta = MetaStore(os.path.join(state_dir, 'theni.db'), info.repos_UUID)
+        else:
+            self.meta = MetaStore(':memory:', info.repos_UUID)
+
+        # a working copy this server left at HEAD needs no update; one that
+        # was touched since, or interrupted while updating, gets a full one
+        head = self.head_rev()
+        if self.meta.wc_rev(self.wcbase) == info.rev.number == head:
+            logger.info('working copy at HEAD r%s', head)
+            self.wc_rev = head
+        else:
+            self.update_wc()
+        self.tree = TreeIndex(self, self.url,
+                urllib.unquote(self.url[len(info.repos_root_URL):]))
+        self.tree.load(head)
 
         logger.info('started svn client on wcbase "%s"', base)
         logger.info(' user: "%s"', getpass.getuser())
         logger.info(' url: "%s"', info.URL)
+        logger.info(' revision: %s', self.wc_rev)
+        logger.info(' state: "%s"', self.meta.filename)
+        logger.info(' svn clients: %d', self.clients.size)
+        logger.info(' direct reads: %s', self.direct)
+
+        metrics.add_collector(self._collect_metrics)
 
         thenisvn_conf = os.path.join(self.wcbase, 'enisvndb.conf')
+        if self.direct:
+            with self.clients.client() as svn:
+                self._stage(svn, thenisvn_conf)
         if not os.path.exists(thenisvn_conf):
             raise Exception('Not a proper theni:svn working capy.')
+        self.load_config(thenisvn_conf)
+
+    @contextlib.contextmanager
+    def _svn(self, path = None, write = False):
+        """An svn client on the working copy; with write, for svn calls
+        that change the working copy."""
+        # path locks are always taken before the working copy lock, the
+        # working copy lock before the write lock
+        if path is not None:
+            with self.path_locks.hold(path):
+                with self._svn(None, write) as svn:
+                    yield svn
+            return
+        with self.wc_lock.shared():
+            if write:
+                with self.write_lock.exclusive():
+                    with self.clients.client() as svn:
+                        yield svn
+            else:
+                with self.clients.client() as svn:
+                    yield svn
 
-        logger.info('reading theni:svn config from "%s"', thenisvn_conf)
-        config = ConfigParser()
-        config.readfp(codecs.open(thenisvn_conf, 'r', 'utf8'))
-        for login, v in config.items('User'):
-            fullname, info = v.split(',')
-            logger.info(' added user %s, %s, %s', login, fullname, info)
-            self.users[login] = fullname, info
-
+    @timed
     def ls(self, path, recursive, folders_only):
-        path = urlparse.urljoin(self.wcbase, path)
-        logger.info('svn ls %s', path)
-        entry_list = self.svn.ls(path.strip(), recurse=recursive)
-        if folders_only:
-            entry_list = filter(lambda e: e.kind == pysvn.node_kind.dir, entry_list)
-        return map(lambda e: (self._shortpath(e.name), e.kind), entry_list)
-
-    def mkfile(self, object_path, object_type, content, comment):
+        self.require_rev()
+        rev = self._head()
+        if self.tree.rev != rev:
+            with self._svn() as svn:
+                self.tree.sync(svn, rev)
+        logger.info('ls %s (tree index r%s)', path, self.tree.rev)
+        return self.tree.ls(path, recursive, folders_only)
+
+    @timed
+    def locks(self, path, recursive):
+        """Return the locks on the objects in path as {path: LockInfo},
+        fetched with one svn list."""
+        url = self._url(path)
+        logger.info('svn list --locks %s', url)
+        locks = {}
+        with self.clients.client() as svn:
+            for dirent, lock in svn.list(url,
+                    recurse=recursive,
+                    dirent_fields=pysvn.SVN_DIRENT_KIND,
+                    fetch_locks=True):
+                if lock is not None:
+                    locks[self.tree.relpath(dirent.repos_path)] = LockInfo(
+                            lock.owner, lock.comment)
+        return locks
+
+    @timed
+    def mkfile(self, object_path, object_type, data, comment, user = ''):
         wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn mkfile: write %s', wcpath)
-        with open(wcpath, 'wb') as f:
-            f.write(content)
-        try:
-            logger.info('svn mkfile: add %s', wcpath)
-            self.svn.add(wcpath)
-            logger.info('svn mkfile: propset %s = %s', 'eni:object-type', object_type)
-            self.svn.propset('eni:object-type', object_type, wcpath)
-        except Exception, e:
-            logger.warn(str(e))
-        logger.info('svn mkfile: checkin %s', wcpath)
-        self.svn.checkin([wcpath], comment)
-
+        with self.path_locks.hold(wcpath):
+            with self._svn(write=True) as svn:
+                self._stage(svn, os.path.dirname(wcpath))
+                logger.info('svn mkfile: write %s', wcpath)
+                write_file(wcpath, data)
+                try:
+                    logger.info('svn mkfile: add %s', wcpath)
+                    svn.add(wcpath)
+                    logger.info('svn mkfile: propset %s = %s', 'eni:object-type', object_type)
+                    svn.propset('eni:object-type', object_type, wcpath)
+                except Exception, e:
+                    logger.warn(str(e))
+                if self.group_commit is None:
+                    logger.info('svn mkfile: checkin %s', wcpath)
+                    rev = svn.checkin([wcpath], comment)
+            if self.group_commit is not None:
+                rev = self.group_commit.commit(user, wcpath, comment, False)
+            self._committed(object_path, object_type, rev, data)
+
+    @timed
     def mkdir(self, folder_path, comment):
         wcpath = self._wcpath(folder_path)
         logger.info('svn mkdir %s', wcpath)
-        if os.path.exists(wcpath):
-            return
-        try:
-            self.svn.mkdir(wcpath, comment, make_parents=True)
-        except Exception, e:
-            logger.warn(str(e))
-        self.svn.checkin([wcpath], comment)
+        with self._svn(wcpath, write=True) as svn:
+            self._stage(svn, wcpath)
+            if os.path.exists(wcpath):
+                return
+            try:
+                svn.mkdir(wcpath, comment, make_parents=True)
+            except Exception, e:
+                logger.warn(str(e))
+            rev = svn.checkin([wcpath], comment)
+        self._committed(folder_path, None, rev)
 
+    @timed
     def cat(self, object_path, object_type, rev = None):
-        self.update_wc()
+        if rev:
+            content = self.cache.get((object_path, object_type, int(rev)))
+            if content is not None:
+                logger.info('svn cat %s@%s (cached)', object_path, rev)
+                return content
+        self.require_rev(rev)
+        if self.direct:
+            url = self._url(object_path, object_type)
+            rev = rev or self._head()
+            logger.info('svn cat %s@%s', url, rev)
+            with self.clients.client() as svn:
+                content = svn.cat(url, self._rev(rev), peg_revision=self._rev(rev))
+        else:
+            wcpath = self._wcpath(object_path, object_type)
+            logger.info('svn cat %s', wcpath)
+            with self._svn() as svn:
+                content = svn.cat(wcpath, self._rev(rev))
+        if rev:
+            # direct reads of HEAD know their revision by now
+            self.cache.put((object_path, object_type, int(rev)), content)
+            logger.debug('object cache: %(hits)d hits, %(misses)d misses, '
+                    '%(entries)d entries, %(bytes)d bytes', self.cache.stats())
+        return content
+
+    @timed
+    def open_object(self, object_path, object_type, rev):
+        """Return a file object with the content of an object at revision rev.
+
+        Small objects come from the cache, an object the working copy holds
+        at that revision is read from disk, anything else is fetched with
+        svn cat.
+        """
+        key = object_path, object_type, int(rev)
+        content = self.cache.get(key)
+        if content is not None:
+            logger.info('svn cat %s@%s (cached)', object_path, rev)
+            return StringIO(content)
+        if self.direct:
+            return StringIO(self.cat(object_path, object_type, rev))
         wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn cat %s', wcpath)
-        return self.svn.cat(wcpath, self._rev(rev))
+        with self._svn(wcpath) as svn:
+            try:
+                entry = svn.info2(wcpath, recurse=False)[0][1]
+                if entry.last_changed_rev.number == int(rev):
+                    logger.info('read %s@%s from working copy', wcpath, rev)
+                    if os.name != 'nt':
+                        return open(wcpath, 'rb')
+                    # an open file could not be replaced by the next check-in
+                    content = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+                    with open(wcpath, 'rb') as f:
+                        shutil.copyfileobj(f, content, BLOCK_SIZE)
+                    content.seek(0)
+                    return content
+            except pysvn.ClientError:
+                pass
+        return StringIO(self.cat(object_path, object_type, rev))
 
-    def checkin(self, object_path, object_type, content, comment):
+    @timed
+    def checkin(self, object_path, object_type, data, comment, user = '', unlock = True):
         wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn checkin: write %s', wcpath)
-        with open(wcpath, 'wb') as f:
-            f.write(content)
-        logger.info('svn checkin: checkin %s', wcpath)
-        self.svn.checkin([wcpath], comment)
-        self.unlock(object_path, object_type)
-
-    def checkout(self, object_path, object_type, comment):
+        if self.group_commit is not None:
+            # the object stays locked for us until the group is committed
+            with self.path_locks.hold(wcpath):
+                with self._svn(write=True) as svn:
+                    self._stage(svn, wcpath)
+                    logger.info('svn checkin: write %s', wcpath)
+                    write_file(wcpath, data)
+                rev = self.group_commit.commit(user, wcpath, comment, unlock)
+                self._committed(object_path, object_type, rev, data)
+            return
+        with self.path_locks.hold(wcpath):
+            with self._svn(write=True) as svn:
+                self._stage(svn, wcpath)
+                logger.info('svn checkin: write %s', wcpath)
+                write_file(wcpath, data)
+                logger.info('svn checkin: checkin %s', wcpath)
+                try:
+                    rev = svn.checkin([wcpath], comment)
+                except pysvn.ClientError:
+                    # never leave uncommitted content behind for readers
+                    svn.revert(wcpath)
+                    raise
+                if unlock:
+                    logger.info('svn unlock %s', wcpath)
+                    svn.unlock(wcpath) #, force=True)
+            self._committed(object_path, object_type, rev, data)
+
+    @timed
+    def commit_group(self, items):
+        """Commit the working copy paths of a check-in group at once.
+
+        items are (wcpath, comment, unlock) tuples; the log message lists
+        the comment of every object.
+        """
+        wcpaths = [wcpath for wcpath, comment, unlock in items]
+        if len(items) == 1:
+            message = items[0][1]
+        else:
+            message = '\n'.join('%s: %s' % (self._relpath(wcpath), comment)
+                    for wcpath, comment, unlock in items)
+        with self._svn(write=True) as svn:
+            logger.info('svn checkin: group of %d objects', len(items))
+            try:
+                rev = svn.checkin(wcpaths, message)
+            except pysvn.ClientError:
+                svn.revert(wcpaths)
+                raise
+            for wcpath, comment, unlock in items:
+                if unlock:
+                    logger.info('svn unlock %s', wcpath)
+                    try:
+                        svn.unlock(wcpath)
+                    except pysvn.ClientError, e:
+                        logger.warn('svn unlock %s: %s', wcpath, str(e))
+        return rev
+
+    @timed
+    def checkout(self, object_path, object_type, comment, user = ''):
         wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn checkout: lock %s', wcpath)
-        self.lock(object_path, object_type, comment)
-        logger.info('svn mkfile: propset %s = %s', 'eni:check-out-comment', comment)
-        self.svn.propset('eni:object-type', object_type, wcpath)
-
+        with self._svn(wcpath, write=True) as svn:
+            self._stage(svn, wcpath)
+            logger.info('svn checkout: lock %s', wcpath)
+            svn.lock(wcpath, comment) #, force=True)
+            logger.info('svn mkfile: propset %s = %s', 'eni:check-out-comment', comment)
+            svn.propset('eni:object-type', object_type, wcpath)
+
+    @timed
     def lock(self, object_path, object_type, comment):
         wcpath = self._wcpath(object_path, object_type)
         logger.info('svn lock: lock %s', wcpath)
-        self.svn.lock(wcpath, comment) #, force=True)
+        with self._svn(wcpath, write=True) as svn:
+            self._stage(svn, wcpath)
+            svn.lock(wcpath, comment) #, force=True)
 
+    @timed
     def unlock(self, object_path, object_type):
         wcpath = self._wcpath(object_path, object_type)
         logger.info('svn unlock %s', wcpath)
-        self.svn.unlock(wcpath) #, force=True)
+        with self._svn(wcpath, write=True) as svn:
+            self._stage(svn, wcpath)
+            svn.unlock(wcpath) #, force=True)
 
+    @timed
     def set_rev_prop(self, folder_path, label):
         url = self.get_url()
         logger.info('svn propset --revprop %s', url)
-        rev = self.svn.revpropset(
-                'eni:label', label,
-                url,
-                revision = pysvn.Revision(pysvn.opt_revision_kind.head),
-                )
+        with self._svn() as svn:
+            rev = svn.revpropset(
+                    'eni:label', label,
+                    url,
+                    revision = pysvn.Revision(pysvn.opt_revision_kind.head),
+                    )
+        self.meta.set_label(rev.number, label)
         return rev.number
 
-    def log(self, object_path, object_type = None):
-        self.update_wc()
-        wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn logger %s', wcpath)
-        return self.svn.log(wcpath)
-        return self.svn.log(wcpath, revprops=['svn:author', 'svn:date', 'svn:logger', 'eni:label',])
+    def checksum(self, object_path, object_type, rev):
+        return self.meta.checksum(self._path(object_path, object_type), int(rev))
+
+    def add_checksum(self, object_path, object_type, rev, checksum):
+        self.meta.add_checksum(self._path(object_path, object_type), int(rev), checksum)
 
+    def prefetch(self, path, user):
+        if self.prefetcher is None:
+            return None
+        objects = []
+        for p, node in self.ls(path, True, False):
+            if node.kind == NODE_FILE:
+                n, e = os.path.splitext(p)
+                guid = node.object_type
+                objects.append((n if guid else p, guid, node.rev))
+        logger.info('prefetching %d objects below "%s"', len(objects), path)
+        return Prefetch(self, objects, self.prefetcher, self.prefetch_budget, user)
+
+    @timed
+    def label_rev(self, label):
+        """Return the newest revision labelled label.
+
+        The label index is built from one log of the whole repository, and
+        then only looks at the revisions that came since.
+        """
+        self.require_rev()
+        head = self._head()
+        rev = self.meta.labels_rev()
+        if rev < head:
+            logger.info('svn log --revprop eni:label %s -r%s:%s', self.root_url, rev + 1, head)
+            with self.clients.client() as svn:
+                entries = svn.log(self.root_url,
+                        revision_start=self._rev(rev + 1),
+                        revision_end=self._rev(head),
+                        peg_revision=self._rev(head),
+                        revprops=['eni:label'])
+            self.meta.add_labels(head, [(e.revision.number, e.revprops['eni:label'])
+                    for e in entries if e.revprops.get('eni:label')])
+        rev = self.meta.find_label(label)
+        if rev is None:
+            raise DBError('label "%s" not found' % label)
+        return rev
+
+    @timed
+    def log(self, object_path, object_type = None):
+        self.require_rev()
+        path = self._path(object_path, object_type)
+        rev, entries = self.meta.history(path, self.max_history)
+        head = self._head()
+        if rev >= head:
+            return entries
+        # only fetch what happened since we last looked
+        url = self._url(object_path, object_type)
+        logger.info('svn log %s -r%s:%s', url, head, rev + 1)
+        with self._svn() as svn:
+            new_entries = svn.log(url,
+                    revision_start=self._rev(head),
+                    revision_end=self._rev(rev + 1),
+                    peg_revision=self._rev(head),
+                    revprops=['svn:author', 'svn:date', 'svn:log', 'eni:label'])
+        self.meta.add_history(path, head, [HistoryEntry(
+                e.revision.number,
+                getattr(e, 'author', ''),
+                getattr(e, 'date', 0),
+                getattr(e, 'message', ''),
+                e.revprops.get('eni:label'),
+                ) for e in new_entries])
+        return self.meta.history(path, self.max_history)[1]
+
+    @timed
     def info(self, object_path, object_type = None, rev = None):
-        self.update_wc()
-        wcpath = self._wcpath(object_path, object_type)
-        logger.info('svn info %s', wcpath)
-        return self.svn.info2(wcpath, self._rev(rev))[0][1]
+        self.require_rev(rev)
+        if self.direct:
+            url = self._url(object_path, object_type)
+            rev = rev or self._head()
+            logger.info('svn info %s@%s', url, rev)
+            with self.clients.client() as svn:
+                entry = svn.info2(url, self._rev(rev), peg_revision=self._rev(rev),
+                        recurse=False)[0][1]
+        else:
+            wcpath = self._wcpath(object_path, object_type)
+            logger.info('svn info %s', wcpath)
+            with self._svn() as svn:
+                entry = svn.info2(wcpath, self._rev(rev))[0][1]
+        return ObjectInfo(
+                NODE_DIR if entry.kind == pysvn.node_kind.dir else NODE_FILE,
+                entry.last_changed_rev.number,
+                entry.last_changed_date,
+                LockInfo(entry.lock.owner, entry.lock.comment) if entry.lock else None,
+                )
 
-    def update_wc(self):
-        logger.info('svn update %s', self.wcbase)
-        self.svn.update(self.wcbase)
+    @timed
+    def update_wc(self, rev = None):
+        with self.wc_lock.exclusive():
+            if rev is not None and self.wc_lock.path is not None:
+                with self.clients.client() as svn:
+                    entry = svn.info2(self.wcbase, recurse=False)[0][1]
+                self.wc_rev = max(self.wc_rev, entry.rev.number)
+            if rev is not None and self.wc_rev >= rev:
+                # somebody else updated while we were waiting
+                return
+            logger.info('svn update %s', self.wcbase)
+            with self.clients.client() as svn:
+                if self.direct:
+                    # the staging area is brought up to date object by object
+                    self.wc_rev = svn.update(self.wcbase, depth=pysvn.depth.empty)[0].number
+                else:
+                    self.wc_rev = svn.update(self.wcbase)[0].number
+            self.meta.set_wc_rev(self.wcbase, self.wc_rev)
+
+    @timed
+    def head_rev(self):
+        with self.clients.client() as svn:
+            entry = svn.info2(self.url, self._rev(None), recurse=False)[0][1]
+        return entry.rev.number
+
+    def refresh_wc(self):
+        head = self.head_rev()
+        if head > self.wc_rev:
+            if self.direct:
+                # HEAD reads move on without touching the working copy
+                self.wc_rev = head
+            else:
+                self.update_wc(head)
 
-    def add_object_type_info(self, guid, ext, desc):
-        logger.info('add object type: %s .%-3s "%s"', guid, ext, desc)
-        self.object_type_db1[guid] = (desc, ext)
-        self.object_type_db2[ext] = guid
+    def require_rev(self, rev = None):
+        """Make sure the working copy is recent enough to read revision rev.
 
-    def get_object_type_info(self, object_type):
-        return self.object_type_db1.get(object_type, ('', ''))
+        Without a background refresher, a read of HEAD checks the repository
+        for new revisions first. Direct reads of an explicit revision need
+        nothing.
+        """
+        if rev:
+            if int(rev) > self.wc_rev and not self.direct:
+                self.update_wc(int(rev))
+        elif self.refresher is None:
+            self.refresh_wc()
+
+    def start_refresh(self, interval):
+        self.refresher = WcRefresher(self, interval)
+        self.refresher.start()
+
+    def _collect_metrics(self):
+        stats = self.cache.stats()
+        labels = self.metric_labels
+        return [
+            ('theni_cache_hits_total', 'counter', labels, stats['hits']),
+            ('theni_cache_misses_total', 'counter', labels, stats['misses']),
+            ('theni_cache_entries', 'gauge', labels, stats['entries']),
+            ('theni_cache_bytes', 'gauge', labels, stats['bytes']),
+            ('theni_wc_revision', 'gauge', labels, self.wc_rev),
+            ]
+
+    def _committed(self, object_path, object_type, rev, data = False):
+        """Record a commit; for an object, data is the file object with the
+        content committed, and the caller still holds its path lock."""
+        if rev is not None and rev.number > 0:
+            self.commit_rev = max(self.commit_rev, rev.number)
+        if data is False:
+            return
+        # the committed content is what the next get-object will ask for
+        if rev is not None and rev.number > 0:
+            crc, size, blocks = 0, 0, []
+            if data is not None:
+                data.seek(0)
+                for block in iter(lambda: data.read(BLOCK_SIZE), ''):
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    if size <= self.cache.max_entry:
+                        blocks.append(block)
+            self.add_checksum(object_path, object_type, rev.number, object_checksum((), crc))
+            if size <= self.cache.max_entry:
+                self.cache.put((object_path, object_type, rev.number), ''.join(blocks))
+        else:
+            self.cache.invalidate(object_path, object_type)
 
-    def get_object_type(self, ext):
-        ext = ext[1:] if ext.startswith('.') else ext
-        return self.object_type_db2.get(ext, GUID_NULL)
+    def _head(self):
+        """The revision HEAD reads are served at."""
+        return max(self.wc_rev, self.commit_rev)
 
-    def get_object_types(self):
-        return self.object_type_db1.keys()
+    def _stage(self, svn, wcpath):
+        """Bring wcpath, with the folders leading to it, into a sparse
+        working copy; a file is updated even when it is there already."""
+        if not self.direct:
+            return
+        path = self.wcbase
+        for name in self._relpath(wcpath).split('/'):
+            path = os.path.join(path, name)
+            if os.path.isdir(path):
+                continue
+            logger.info('svn stage %s', path)
+            svn.update(path, depth=pysvn.depth.empty,
+                    depth_is_sticky=not os.path.exists(path))
 
     def _rev(self, rev):
         if rev:
             return pysvn.Revision( pysvn.opt_revision_kind.number, int(rev))
         return pysvn.Revision( pysvn.opt_revision_kind.head)
 
+    def _relpath(self, wcpath):
+        return wcpath[len(self.wcbase):].strip('/')
+
     def _wcpath(self, object_path, object_type = None):
         ext = self._get_object_ext(object_type)
         return os.path.join(self.wcbase, object_path) + ext
 
     def get_url(self):
-        return self.info(self.wcbase).URL
+        return self.url
+
+    def _url(self, object_path, object_type = None):
+        path = self._path(object_path, object_type)
+        if not path:
+            return self.url
+        return '%s/%s' % (self.url, urllib.quote(path.encode('utf8')))
+
+
+class CasDB(BaseDB):
+    """Objects in a local content-addressed store, without Subversion.
+
+    Contents are kept once per distinct content as blobs named by their
+    SHA-1 below objects/. Every change is appended to the journal, one JSON
+    record per line: commits of object contents and folders, labels, locks,
+    unlocks and checksums of contents. At startup the journal is replayed into the index of paths,
+    history, labels and locks that serves all reads, so any revision of an
+    object is as cheap to read as HEAD.
+    """
+
+    def __init__(self, base = '.', max_history = 0):
+        BaseDB.__init__(self)
+        self.base = base
+        self.objects = os.path.join(base, 'objects')
+        self.max_history = max_history
+
+        self.rev = 0
+        self.revs = [('', 0, '', [])]  # rev -> (author, date, message, paths)
+        self.history = {'' : [(0, None)]}  # path -> [(rev, blob)], oldest first
+        self.labels = {}        # rev -> label
+        self.label_revs = {}    # label -> newest rev
+        self.lock_info = {}
+        self.checksums = {}     # blob -> object_checksum(), once known
+        self.tree = Tree()
+        self.tree.add('', TreeNode(NODE_DIR, None, 0, 0))
+        self.__lock = threading.Lock()
+
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+        journal = os.path.join(base, 'journal')
+        size = 0
+        if os.path.exists(journal):
+            with open(journal, 'rb') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        self.__apply(json.loads(line))
+                        size += len(line)
+                    else:
+                        logger.warn('ignoring incomplete journal record')
+        self.journal = open(journal, 'ab')
+        # new records must not continue an incomplete one
+        self.journal.truncate(size)
+
+        logger.info('started content-addressed store on "%s"', base)
+        logger.info(' revision: %s', self.rev)
+        logger.info(' objects: %d', len(self.history))
+
+        metrics.add_collector(self._collect_metrics)
+
+        self.load_config(os.path.join(base, 'enisvndb.conf'))
+
+    def __apply(self, record):
+        op = record['op']
+        if op == 'commit':
+            rev, date = record['rev'], record['date']
+            paths = []
+            # ls walks the tree without our lock
+            with self.tree.lock:
+                for path, kind, object_type, blob in record['changes']:
+                    self.history.setdefault(path, []).append((rev, blob))
+                    if path not in self.tree.nodes:
+                        self.tree.add(path, TreeNode(kind, object_type, rev, date))
+                    self.tree.touch(path, rev, date)
+                    paths.append(path)
+            self.revs.append((record['author'], date, record['message'], paths))
+            self.checksums.update(record.get('checksums', {}))
+            self.rev = rev
+        elif op == 'label':
+            self.labels[record['rev']] = record['label']
+            self.label_revs[record['label']] = max(record['rev'],
+                    self.label_revs.get(record['label'], 0))
+        elif op == 'lock':
+            self.lock_info[record['path']] = LockInfo(record['owner'], record['comment'])
+        elif op == 'unlock':
+            self.lock_info.pop(record['path'], None)
+        elif op == 'checksum':
+            self.checksums[record['blob']] = record['checksum']
+
+    def __record(self, record, durable = True):
+        """Make record durable in the journal, then apply it. A record that
+        is not durable may be lost with the system."""
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        if durable:
+            os.fsync(self.journal.fileno())
+        self.__apply(record)
+
+    def __store(self, data):
+        """Add the content of the file object data, return its blob name."""
+        fd, tmppath = tempfile.mkstemp(prefix='.theni-', dir=self.objects)
+        try:
+            sha = hashlib.sha1()
+            crc = 0
+            with os.fdopen(fd, 'wb') as f:
+                if data is not None:
+                    data.seek(0)
+                    for block in iter(lambda: data.read(BLOCK_SIZE), ''):
+                        sha.update(block)
+                        crc = zlib.crc32(block, crc)
+                        f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            blob = sha.hexdigest()
+            self.checksums[blob] = object_checksum((), crc)
+            path = self.__blob_path(blob)
+            if os.path.exists(path):
+                os.remove(tmppath)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        return blob
+
+    def __blob_path(self, blob):
+        return os.path.join(self.objects, blob[:2], blob[2:])
+
+    def __commit(self, changes, comment, user):
+        # folders that do not exist yet are created along with the change
+        parents = []
+        for path, kind, object_type, blob in changes:
+            parent = split_path(path)[0]
+            while parent and parent not in self.tree.nodes and \
+                    parent not in [p[0] for p in parents]:
+                parents.insert(0, (parent, NODE_DIR, None, None))
+                parent = split_path(parent)[0]
+        self.__record({
+            'op' : 'commit',
+            'rev' : self.rev + 1,
+            'author' : user,
+            'date' : time.time(),
+            'message' : comment,
+            'changes' : parents + changes,
+            'checksums' : dict((blob, self.checksums[blob])
+                    for path, kind, object_type, blob in changes
+                    if blob in self.checksums),
+            })
+        return self.rev
+
+    def __find(self, path, rev = None):
+        """Return the (rev, blob) of path current at revision rev."""
+        entries = self.history.get(path)
+        if entries and rev:
+            entries = entries[:bisect.bisect_right([r for r, blob in entries], int(rev))]
+        if not entries:
+            raise DBError('path "%s" not found' % path)
+        return entries[-1]
+
+    def __check_lock(self, path, user):
+        # an empty user-name is an owner of its own, not a wildcard
+        lock = self.lock_info.get(path)
+        if lock is not None and lock.owner != user:
+            raise DBError('"%s" is checked out by %s' % (path, lock.owner))
+
+    @timed
+    def ls(self, path, recursive, folders_only):
+        logger.info('ls %s (r%s)', path, self.rev)
+        return self.tree.ls(path, recursive, folders_only)
+
+    def locks(self, path, recursive):
+        path = path.strip('/')
+        prefix = path + '/' if path else ''
+        with self.__lock:
+            return dict((p, lock) for p, lock in self.lock_info.items()
+                    if p == path or p.startswith(prefix) and
+                        (recursive or '/' not in p[len(prefix):]))
+
+    @timed
+    def mkfile(self, object_path, object_type, data, comment, user = ''):
+        path = self._path(object_path, object_type)
+        blob = self.__store(data)
+        logger.info('cas mkfile %s (%s)', path, blob)
+        with self.__lock:
+            self.__commit([(path, NODE_FILE, object_type, blob)], comment, user)
+
+    @timed
+    def mkdir(self, folder_path, comment):
+        path = folder_path.strip('/')
+        logger.info('cas mkdir %s', path)
+        with self.__lock:
+            if path not in self.tree.nodes:
+                self.__commit([(path, NODE_DIR, None, None)], comment, '')
 
-    def _get_object_ext(self, object_type):
-        desc, ext = self.get_object_type_info(object_type)
-        return '.%s' % ext if ext else ''
+    @timed
+    def cat(self, object_path, object_type, rev = None):
+        f = self.open_object(object_path, object_type, rev)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    @timed
+    def open_object(self, object_path, object_type, rev):
+        path = self._path(object_path, object_type)
+        rev, blob = self.__find(path, rev)
+        if blob is None:
+            raise DBError('"%s" is a folder' % path)
+        logger.info('cas cat %s@%s (%s)', path, rev, blob)
+        return open(self.__blob_path(blob), 'rb')
+
+    @timed
+    def checkin(self, object_path, object_type, data, comment, user = '', unlock = True):
+        path = self._path(object_path, object_type)
+        blob = self.__store(data)
+        logger.info('cas checkin %s (%s)', path, blob)
+        with self.__lock:
+            self.__find(path)
+            self.__check_lock(path, user)
+            self.__commit([(path, NODE_FILE, object_type, blob)], comment, user)
+            if unlock and path in self.lock_info:
+                self.__record({'op' : 'unlock', 'path' : path})
+
+    @timed
+    def checkout(self, object_path, object_type, comment, user = ''):
+        path = self._path(object_path, object_type)
+        logger.info('cas checkout %s', path)
+        with self.__lock:
+            self.__find(path)
+            self.__check_lock(path, user)
+            self.__record({'op' : 'lock', 'path' : path,
+                'owner' : user, 'comment' : comment})
+
+    @timed
+    def lock(self, object_path, object_type, comment):
+        self.checkout(object_path, object_type, comment)
+
+    @timed
+    def unlock(self, object_path, object_type):
+        path = self._path(object_path, object_type)
+        logger.info('cas unlock %s', path)
+        with self.__lock:
+            if path in self.lock_info:
+                self.__record({'op' : 'unlock', 'path' : path})
+
+    @timed
+    def set_rev_prop(self, folder_path, label):
+        with self.__lock:
+            logger.info('cas label r%s: %s', self.rev, label)
+            self.__record({'op' : 'label', 'rev' : self.rev, 'label' : label})
+            return self.rev
+
+    def checksum(self, object_path, object_type, rev):
+        rev, blob = self.__find(self._path(object_path, object_type), rev)
+        return self.checksums.get(blob)
+
+    def add_checksum(self, object_path, object_type, rev, checksum):
+        rev, blob = self.__find(self._path(object_path, object_type), rev)
+        if blob is None:
+            return
+        with self.__lock:
+            # recomputed on the next read, should the record be lost
+            if blob not in self.checksums:
+                self.__record({'op' : 'checksum', 'blob' : blob,
+                        'checksum' : checksum}, durable=False)
+
+    def label_rev(self, label):
+        rev = self.label_revs.get(label)
+        if rev is None:
+            raise DBError('label "%s" not found' % label)
+        return rev
+
+    @timed
+    def log(self, object_path, object_type = None):
+        path = self._path(object_path, object_type)
+        node = self.tree.nodes.get(path)
+        if node is None:
+            raise DBError('path "%s" not found' % path)
+        if node.kind == NODE_DIR:
+            # a folder changes with everything below it
+            prefix = path + '/' if path else ''
+            revs = [rev for rev in xrange(self.rev, 0, -1)
+                    if any(p == path or p.startswith(prefix) for p in self.revs[rev][3])]
+        else:
+            revs = [rev for rev, blob in reversed(self.history[path])]
+        if self.max_history:
+            revs = revs[:self.max_history]
+        entries = []
+        for rev in revs:
+            author, date, message, paths = self.revs[rev]
+            entries.append(HistoryEntry(rev, author, date, message, self.labels.get(rev)))
+        return entries
+
+    @timed
+    def info(self, object_path, object_type = None, rev = None):
+        path = self._path(object_path, object_type)
+        rev, blob = self.__find(path, rev)
+        return ObjectInfo(
+                NODE_DIR if blob is None else NODE_FILE,
+                rev,
+                self.revs[rev][1],
+                self.lock_info.get(path),
+                )
+
+    def refresh_wc(self):
+        pass
+
+    def require_rev(self, rev = None):
+        pass
 
-    def _shortpath(self, path):
-        short_path = path[len(self.wcbase):]
-        if short_path[0] == '/':
-            short_path = short_path[1:]
-        return short_path
+    def start_refresh(self, interval):
+        pass
+
+    def _collect_metrics(self):
+        return [
+            ('theni_wc_revision', 'gauge', self.metric_labels, self.rev),
+            ]
+
+    def get_url(self):
+        return 'file://' + os.path.abspath(self.base)
 
 
 class EniAccess:
@@ -237,20 +2362,45 @@ class EniAccess:
         return '0x%04X' % self.access
 
 
+def xml_text(value):
+    if not isinstance(value, basestring):
+        value = str(value)
+    return escape(value)
+
+
+def xml_elem(tag, value):
+    return '<%s>%s</%s>\n' % (tag, xml_text(value), tag)
+
+
+def xml_fragments(r):
+    """Turn what _response() and _data() return into XML fragments."""
+    if r is None:
+        return iter(())
+    if isinstance(r, basestring):
+        return iter((r,))
+    if isinstance(r, dict):
+        return (xml_elem(k, v) for k, v in r.items())
+    return iter(r)
+
+
 class EniHandshake:
     def __init__(self, req_etree):
         self.__etree = req_etree
         self.__username = self.__etree.attrib['user-name']
         logger.debug('ENI handshake request, username: %s', self.__username)
 
-    def response(self):
+    def render(self):
         fingerprint1 = '1' * 32
         fingerprint2 = '2' * 32
-        return '<handshake user-name="%s" fingerprint-1="%s" fingerprint-2="%s"/>' % (
-                self.__username, fingerprint1, fingerprint2
+        yield '<handshake user-name=%s fingerprint-1="%s" fingerprint-2="%s"/>' % (
+                quoteattr(self.__username), fingerprint1, fingerprint2
                 )
 
 
+# the error of a command refused for load; sending it again later is fine
+ERROR_BUSY = 16391
+
+
 class EniError:
     def __init__(self, eni_cmd, error_code, error_text = ''):
         logger.debug('EniError %s %s %s', eni_cmd, error_code, error_text)
@@ -258,30 +2408,71 @@ class EniError:
         self.__error_code = error_code
         self.__error_text = error_text
 
-    def response(self):
-        s = '<response command="%s">\n' % self._eni_cmd
-        s += '<error>\n'
-        s += '<error-code>%s</error-code>\n' % self.__error_code
-        s += '<error-text>%s (%s)</error-text>\n' % (self.__error_text, self.__error_code)
-        s += '</error>\n'
-        s += '<data/>\n'
-        s += '</response>'
-        return s
+    def render(self):
+        yield '<response command=%s>\n' % quoteattr(self._eni_cmd)
+        yield '<error>\n'
+        yield xml_elem('error-code', self.__error_code)
+        yield xml_elem('error-text', '%s (%s)' % (self.__error_text, self.__error_code))
+        yield '</error>\n'
+        yield '<data/>\n'
+        yield '</response>'
+
+
+def requested_rev(db, version, label):
+    """The revision a request asks for with version or label, None for HEAD."""
+    if version:
+        return version
+    if label:
+        return db.label_rev(label)
+    return None
+
+
+def object_info_fragments(object_path, object_type, info):
+    yield xml_elem('object-path', object_path)
+    yield xml_elem('object-type', object_type)
+    yield xml_elem('change-date', format_date_time(info.date))
+    if info.lock:
+        yield xml_elem('checked-out-by', info.lock.owner)
+        yield xml_elem('check-out-comment', info.lock.comment)
+    else:
+        yield '<checked-out-by></checked-out-by>\n'
+        yield '<check-out-comment></check-out-comment>\n'
+    yield xml_elem('access', EniAccess('rwd'))
 
 
 class BaseEniCmd:
+    # the response only depends on the configuration and the request
+    # fields of _static_key
+    static = False
+    prefetch_root = None
+    # the Scheduler class of the command
+    priority = INTERACTIVE
+
     def __init__(self, eni_cmd, req_etree):
         logger.info('ENI service request, command: %s', eni_cmd.upper())
         #logger.info('REQUEST command: %s (user-name: %s)' % (_eni_cmd, req_etree.attrib['user-name']))
         self._eni_cmd = eni_cmd
+        self.user_name = req_etree.attrib.get('user-name', '')
         self.__etree = req_etree
+        # the database of the project the request is for, set by EniRequest
+        self.vcs = vcs
 
         self.__eni_cmd_elem = self.__etree.find(self._eni_cmd)
         d = self.__etree.find('data')
-        if d is not None and d.text is not None:
-            self.text = base64.b64decode(d.text.strip())
+        if getattr(d, 'payload', None) is not None and d.payload.tell():
+            # decoded by EniTreeBuilder while the request was parsed
+            self.data = d.payload
+            self.data_size = self.data.tell()
+        elif d is not None and d.text:
+            self.data = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            decoder = Base64Decoder(self.data)
+            for i in xrange(0, len(d.text), BLOCK_SIZE):
+                decoder.feed(d.text[i:i + BLOCK_SIZE])
+            decoder.close()
+            self.data_size = self.data.tell()
         else:
-            self.text = ''
+            self.data = None
+            self.data_size = 0
 
     def get(self, elem, default = ''):
         d = self.__eni_cmd_elem.find(elem)
@@ -297,25 +2488,32 @@ class BaseEniCmd:
             self._do()
         except pysvn.ClientError, e:
             raise EniError(self._eni_cmd, 0xffff, 'svn client error: %s' % str(e))
+        except DBError, e:
+            raise EniError(self._eni_cmd, 0xffff, str(e))
 
     def _do(self):
         pass
 
-    def response(self):
-        s = '<response command="%s">\n' % self._eni_cmd
-        s += '<success/>\n'
-        r = self._response()
-        if r:
-            s += '<%s>\n' % self._eni_cmd
-            if isinstance(r, dict):
-                for k, v in r.items():
-                    s += '<{0}>{1}</{0}>\n'.format(k, v)
-            else:
-                s += r
-            s += '</%s>\n' % self._eni_cmd
-        s += self._data()
-        s += '</response>'
-        return s
+    def render(self):
+        if self.static:
+            return iter([self.vcs.static_response(self._static_key(),
+                    lambda: ''.join(map(encode_fragment, self._render())))])
+        return self._render()
+
+    def _render(self):
+        yield '<response command=%s>\n' % quoteattr(self._eni_cmd)
+        yield '<success/>\n'
+        fragments = xml_fragments(self._response())
+        first = next(fragments, None)
+        if first:
+            yield '<%s>\n' % self._eni_cmd
+            yield first
+            for fragment in fragments:
+                yield fragment
+            yield '</%s>\n' % self._eni_cmd
+        for fragment in xml_fragments(self._data()):
+            yield fragment
+        yield '</response>'
 
     def _response(self):
         return None
@@ -323,6 +2521,9 @@ class BaseEniCmd:
     def _data(self):
         return '<data/>\n'
 
+    def _static_key(self):
+        return self._eni_cmd
+
 
 class EniCmd_login(BaseEniCmd):
     def __init__(self, eni_cmd, req_etree):
@@ -330,7 +2531,7 @@ class EniCmd_login(BaseEniCmd):
         logger.info(' user-name: %s', req_etree.attrib['user-name'])
 
     def _do(self):
-        vcs.update_wc()
+        self.vcs.refresh_wc()
 
 
 class EniCmd_logout(BaseEniCmd):
@@ -350,10 +2551,11 @@ class EniCmd_check_in_object(BaseEniCmd):
         logger.info(' object-type: %s', self.object_type)
         logger.info(' comment: %s', self.comment)
 
-        logger.debug(self.text)
+        logger.debug(' data: %d bytes', self.data_size)
 
     def _do(self):
-        vcs.checkin(self.object_path, self.object_type, self.text, self.comment)
+        self.vcs.checkin(self.object_path, self.object_type, self.data, self.comment,
+                self.user_name)
 
 
 class EniCmd_check_out_object(BaseEniCmd):
@@ -369,7 +2571,7 @@ class EniCmd_check_out_object(BaseEniCmd):
         logger.info(' comment: %s', self.comment)
 
     def _do(self):
-        vcs.checkout(self.object_path, self.object_type, self.comment)
+        self.vcs.checkout(self.object_path, self.object_type, self.comment, self.user_name)
 
 
 class EniCmd_create_folder(BaseEniCmd):
@@ -381,7 +2583,7 @@ class EniCmd_create_folder(BaseEniCmd):
         logger.info(' folder-path: %s', self.folder_path)
 
     def _do(self):
-        vcs.mkdir(self.folder_path, 'Initial check-in (commit)')
+        self.vcs.mkdir(self.folder_path, 'Initial check-in (commit)')
 
 
 class EniCmd_create_object(BaseEniCmd):
@@ -396,10 +2598,11 @@ class EniCmd_create_object(BaseEniCmd):
         logger.info(' object-type: %s', self.object_type)
         logger.info(' no-history: %s', self.no_history)
 
-        logger.debug(self.text)
+        logger.debug(' data: %d bytes', self.data_size)
 
     def _do(self):
-        vcs.mkfile(self.object_path, self.object_type, self.text, 'Initial check-in (commit)')
+        self.vcs.mkfile(self.object_path, self.object_type, self.data, 'Initial check-in (commit)',
+                self.user_name)
 
 
 class EniCmd_delete_folder(BaseEniCmd):
@@ -468,6 +2671,10 @@ class EniCmd_dir(BaseEniCmd):
         self.recursive = self.get_bool('recursive')
         self.folders_only = self.get_bool('folders-only')
         self.no_change_date = self.get_bool('no-change-date')
+        # the first recursive dir of a connection opens a project
+        if self.recursive:
+            self.prefetch_root = self.root_path
+            self.priority = BULK
 
         logger.info(' root-path: %s', self.root_path)
         logger.info(' recursive: %s', self.recursive)
@@ -476,31 +2683,40 @@ class EniCmd_dir(BaseEniCmd):
 
     def _do(self):
         try:
-            self.dir_entries = vcs.ls(self.root_path, self.recursive, self.folders_only)
+            self.dir_entries = self.vcs.ls(self.root_path, self.recursive, self.folders_only)
         except Exception, e:
             raise EniError(self._eni_cmd, 2054, 'path "%s" not found' % self.root_path)
+        # dates come with the tree index, the locks of all objects with
+        # one more request, instead of an info per object
+        self.locks = {}
+        if not self.folders_only:
+            self.locks = self.vcs.locks(self.root_path, self.recursive)
 
     def _response(self):
-        s = ''
-        for p, t in self.dir_entries:
-            s += '<object-info>\n'
-            if t == pysvn.node_kind.dir:
-                s += ' <folder-path>%s</folder-path>\n' % p
-                s += ' <access>%s</access>\n' % EniAccess('rwd')
-            elif t == pysvn.node_kind.file:
+        access = ' ' + xml_elem('access', EniAccess('rwd'))
+        for p, node in self.dir_entries:
+            yield '<object-info>\n'
+            if node.kind == NODE_DIR:
+                yield ' ' + xml_elem('folder-path', p)
+                yield access
+            elif node.kind == NODE_FILE:
                 n, e = os.path.splitext(p)
-                guid = vcs.get_object_type(e)
-                s += ' <object-path>%s</object-path>\n' % (n if guid else p)
-                s += ' <object-type>%s</object-type>\n' % guid
-                s += ' <access>%s</access>\n' % EniAccess('rwd')
-                #s += '<change-date>%s</change-date>\n' % format_date_time(self.info.last_changed_date)
-                #if self.info.lock:
-                #    s += '<checked-out-by>%s</checked-out-by>\n' % self.info.lock.owner
-                #    s += '<check-out-comment>%s</check-out-comment>\n' % self.info.lock.comment
+                guid = node.object_type
+                yield ' ' + xml_elem('object-path', n if guid else p)
+                yield ' ' + xml_elem('object-type', guid)
+                yield access
+                if not self.no_change_date:
+                    yield ' ' + xml_elem('change-date', format_date_time(node.date))
+                lock = self.locks.get(p)
+                if lock:
+                    yield ' ' + xml_elem('checked-out-by', lock.owner)
+                    yield ' ' + xml_elem('check-out-comment', lock.comment)
+                else:
+                    yield ' <checked-out-by></checked-out-by>\n'
+                    yield ' <check-out-comment></check-out-comment>\n'
             else:
                 logger.error('node kind none or unknown')
-            s += '</object-info>\n'
-        return s
+            yield '</object-info>\n'
 
 
 class EniCmd_reset_version(BaseEniCmd):
@@ -518,7 +2734,15 @@ class EniCmd_reset_version(BaseEniCmd):
         logger.info(' version: %s', self.version)
 
     def _do(self):
-        logger.warn('half-implemented cmd: %s', self._eni_cmd)
+        # the old content becomes the newest version
+        rev = requested_rev(self.vcs, self.version, self.label)
+        info = self.vcs.info(self.object_path, self.object_type, rev)
+        content = self.vcs.open_object(self.object_path, self.object_type, info.rev)
+        try:
+            self.vcs.checkin(self.object_path, self.object_type, content,
+                    'Reset to version %s' % info.rev, self.user_name, unlock=False)
+        finally:
+            content.close()
 
 
 class EniCmd_set_folder_label(BaseEniCmd):
@@ -535,7 +2759,7 @@ class EniCmd_set_folder_label(BaseEniCmd):
 
     def _do(self):
         logger.warn('half-implemented cmd: %s', self._eni_cmd)
-        vcs.set_rev_prop(self.folder_path, self.label)
+        self.vcs.set_rev_prop(self.folder_path, self.label)
 
 
 class EniCmd_get_object(BaseEniCmd):
@@ -555,25 +2779,38 @@ class EniCmd_get_object(BaseEniCmd):
         logger.info(' version: %s', self.version)
 
     def _do(self):
-        self.text = vcs.cat(self.object_path, self.object_type, self.version)
-        self.info = vcs.info(self.object_path, self.object_type, self.version)
+        rev = requested_rev(self.vcs, self.version, self.label)
+        self.info = self.vcs.info(self.object_path, self.object_type, rev)
+        self.known_checksum = self.vcs.checksum(self.object_path, self.object_type, self.info.rev)
+        if self.checksum and self.checksum.upper() == self.known_checksum:
+            # the client has this version already
+            logger.info('unchanged %s@%s', self.object_path, self.info.rev)
+            metrics.inc('theni_unchanged_objects_total')
+            self.content = None
+            return
+        # key the content by the revision it last changed in, so every
+        # HEAD read of an unchanged object is a cache hit
+        self.content = self.vcs.open_object(self.object_path, self.object_type, self.info.rev)
 
     def _response(self):
-        s = ''
-        s += '<object-path>%s</object-path>\n' % self.object_path
-        s += '<object-type>%s</object-type>\n' % self.object_type
-        s += '<change-date>%s</change-date>\n' % format_date_time(self.info.last_changed_date)
-        if self.info.lock:
-            s += '<checked-out-by>%s</checked-out-by>\n' % self.info.lock.owner
-            s += '<check-out-comment>%s</check-out-comment>\n' % self.info.lock.comment
-        else:
-            s += '<checked-out-by></checked-out-by>\n'
-            s += '<check-out-comment></check-out-comment>\n'
-        s += '<access>%s</access>\n' % EniAccess('rwd')
-        return s
+        return object_info_fragments(self.object_path, self.object_type, self.info)
 
     def _data(self):
-        return '<data>%s</data>\n' % base64.b64encode(self.text)
+        if self.content is None:
+            return
+        yield '<data>'
+        crc = 0
+        try:
+            for block in iter(lambda: self.content.read(BLOCK_SIZE), ''):
+                if self.known_checksum is None:
+                    crc = zlib.crc32(block, crc)
+                yield base64.b64encode(block)
+        finally:
+            self.content.close()
+        yield '</data>\n'
+        if self.known_checksum is None:
+            self.vcs.add_checksum(self.object_path, self.object_type, self.info.rev,
+                    object_checksum((), crc))
 
 
 class EniCmd_get_object_info(BaseEniCmd):
@@ -591,21 +2828,16 @@ class EniCmd_get_object_info(BaseEniCmd):
         logger.info(' version: %s', self.version)
 
     def _do(self):
-        logger.warn('half-implemented cmd: %s', self._eni_cmd)
+        self.info = self.vcs.info(self.object_path, self.object_type,
+                requested_rev(self.vcs, self.version, self.label))
 
     def _response(self):
-        d = {
-            'object-path' : self.object_path,
-            'object-type\n' : self.object_type,
-            'change-date' : '',
-            'checked-out-by' : '',
-            'check-out-comment' : '',
-            'access' : EniAccess('rwd'),
-            }
-        return d
+        return object_info_fragments(self.object_path, self.object_type, self.info)
 
 
 class EniCmd_get_object_type(BaseEniCmd):
+    static = True
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
@@ -613,8 +2845,15 @@ class EniCmd_get_object_type(BaseEniCmd):
 
         logger.info(' guid: %s', self.guid)
 
+    def _do(self):
+        # responses for any guid a client makes up would fill the memory
+        self.static = self.guid in self.vcs.get_object_types()
+
+    def _static_key(self):
+        return self._eni_cmd, self.guid
+
     def _response(self):
-        desc, ext = vcs.get_object_type_info(self.guid)
+        desc, ext = self.vcs.get_object_type_info(self.guid)
         return {
             'guid' : self.guid,
             'extension' : ext,
@@ -623,12 +2862,14 @@ class EniCmd_get_object_type(BaseEniCmd):
 
 
 class EniCmd_get_object_type_list(BaseEniCmd):
+    static = True
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
     def _response(self):
         s = ''
-        for guid in vcs.get_object_types():
+        for guid in self.vcs.get_object_types():
             s += '<guid>%s</guid>\n' % guid
         return s
 
@@ -642,35 +2883,30 @@ class EniCmd_register_object_types(BaseEniCmd):
 
 
 class EniCmd_get_server_settings(BaseEniCmd):
+    static = True
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
     def _response(self):
-        return {
-            'comm-timeout' : 10, # seconds
-            'idle-interval' : 60, # seconds
-            'allow-anonymous' : 'true',
-            'client-expiration' : 2, # minutes
-            'max-trials' : 10,
-            'active-driver' : 'theni:svn',
-            }
+        return SERVER_SETTINGS
 
 
 class EniCmd_get_users(BaseEniCmd):
+    static = True
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
     def _response(self):
-        s = ''
-        for login, k in vcs.users.items():
-            s += '<user>\n'
-            s += '<name>%s</name>\n' % login
-            s += '<full-name>%s</full-name>\n' % k[0]
-            s += '<description>%s</description>\n' % k[1]
-            s += '<active>%s</active>\n' % True
-            s += '<logged-in>%s</logged-in>\n' % True
-            s += '</user>\n'
-        return s
+        for login, k in self.vcs.users.items():
+            yield '<user>\n'
+            yield xml_elem('name', login)
+            yield xml_elem('full-name', k[0])
+            yield xml_elem('description', k[1])
+            yield xml_elem('active', True)
+            yield xml_elem('logged-in', True)
+            yield '</user>\n'
 
 
 class EniCmd_get_driver_info(BaseEniCmd):
@@ -682,6 +2918,8 @@ class EniCmd_get_driver_info(BaseEniCmd):
 
 
 class EniCmd_get_object_history(BaseEniCmd):
+    priority = BULK
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
@@ -692,39 +2930,37 @@ class EniCmd_get_object_history(BaseEniCmd):
         logger.info(' object-type: %s', self.object_type)
 
     def _do(self):
-        self.versions = vcs.log(self.object_path, self.object_type)
-        self.info = vcs.info(self.object_path, self.object_type)
+        self.versions = self.vcs.log(self.object_path, self.object_type)
+        self.info = self.vcs.info(self.object_path, self.object_type)
 
     def _response(self):
-        s = ''
-        s += '<object-info>\n'
-        s += '<object-path>%s</object-path>\n' % self.object_path
-        s += '<object-type>%s</object-type>\n' % self.object_type
-        s += '<change-date>%s</change-date>\n' % format_date_time(self.info.last_changed_date)
+        yield '<object-info>\n'
+        yield xml_elem('object-path', self.object_path)
+        yield xml_elem('object-type', self.object_type)
+        yield xml_elem('change-date', format_date_time(self.info.date))
         if self.info.lock:
-            s += '<checked-out-by>%s</checked-out-by>\n' % self.info.lock.owner
-            s += '<check-out-comment>%s</check-out-comment>\n' % self.info.lock.comment
+            yield xml_elem('checked-out-by', self.info.lock.owner)
+            yield xml_elem('check-out-comment', self.info.lock.comment)
         else:
-            s += '<checked-out-by></checked-out-by>\n'
-            s += '<check-out-comment></check-out-comment>\n'
-        s += '</object-info>\n'
+            yield '<checked-out-by></checked-out-by>\n'
+            yield '<check-out-comment></check-out-comment>\n'
+        yield '</object-info>\n'
         for v in self.versions:
-            s += '<version>\n'
-            s += '<version>%s</version>\n' % v.revision.number
-            try:
-                s += '<label>%s</label>\n' % v.revprops['eni:label']
-            except KeyError:
-                pass
-            s += '<date>%s</date>\n' % format_date_time(v.date)
-            s += '<comment>%s</comment>\n' % v.message
-            s += '<action>%s</action>\n' % 'undefined'
-            s += '<user-name>%s</user-name>\n' % v.author
-            s += '<pinned>false</pinned>\n'
-            s += '</version>\n'
-        return s
+            yield '<version>\n'
+            yield xml_elem('version', v.rev)
+            if v.label:
+                yield xml_elem('label', v.label)
+            yield xml_elem('date', format_date_time(v.date))
+            yield xml_elem('comment', v.message or '')
+            yield '<action>undefined</action>\n'
+            yield xml_elem('user-name', v.author or '')
+            yield '<pinned>false</pinned>\n'
+            yield '</version>\n'
 
 
 class EniCmd_get_folder_history(BaseEniCmd):
+    priority = BULK
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
@@ -733,8 +2969,8 @@ class EniCmd_get_folder_history(BaseEniCmd):
         logger.info(' folder-path: %s', self.folder_path)
 
     def _do(self):
-        self.versions = vcs.log(self.folder_path)
-        self.info = vcs.info(self.folder_path)
+        self.versions = self.vcs.log(self.folder_path)
+        self.info = self.vcs.info(self.folder_path)
 
     def _response(self):
         #time.sleep(10)
@@ -746,7 +2982,7 @@ class EniCmd_get_folder_history(BaseEniCmd):
             s += '<folder-path>%s</folder-path>\n' % self.folder_path
             s += '<object-path>%s</object-path>\n' % '{9A9A3E90-D363-11d5-823E-0050DA6124B7}'
             s += '<access>%s</access>\n' % EniAccess('rwd')
-            s += '<change-date>%s</change-date>\n' % format_date_time(self.info.last_changed_date)
+            s += '<change-date>%s</change-date>\n' % format_date_time(self.info.date)
             s += '<checked-out-by></checked-out-by>\n'
             s += '<check-out-comment></check-out-comment>\n'
             s += '</object-info>\n'
@@ -754,7 +2990,7 @@ class EniCmd_get_folder_history(BaseEniCmd):
                 s += '<version>\n'
                 s += '<object-path>%s</object-path>\n' % self.folder_path
                 s += '<object-type>%s</object-type>\n' % self.folder_path
-                s += '<version>%s</version>\n' % v.revision.number
+                s += '<version>%s</version>\n' % v.rev
                 s += '<label>%s</label>\n' % 'xxx'
                 s += '<date>%s</date>\n' % format_date_time(v.date)
                 s += '<comment>%s</comment>\n' % v.message
@@ -766,6 +3002,8 @@ class EniCmd_get_folder_history(BaseEniCmd):
 
 
 class EniCmd_get_permissions(BaseEniCmd):
+    static = True
+
     def __init__(self, eni_cmd, req_etree):
         BaseEniCmd.__init__(self, eni_cmd, req_etree)
 
@@ -810,7 +3048,230 @@ class EniCmd_undo_check_out_object(BaseEniCmd):
         logger.info(' object-type: %s', self.object_type)
 
     def _do(self):
-        vcs.unlock(self.object_path, self.object_type)
+        self.vcs.unlock(self.object_path, self.object_type)
+
+
+def encode_fragment(fragment):
+    if isinstance(fragment, unicode):
+        return fragment.encode('ISO-8859-1', 'xmlcharrefreplace')
+    return fragment
+
+
+class ChunkedWriter:
+    """Writes a response body with HTTP/1.1 chunked transfer encoding.
+
+    Small fragments are collected until at least chunk_size bytes are
+    pending, so every chunk costs a single write to the socket.
+    """
+
+    def __init__(self, wfile, chunk_size = 16 << 10):
+        self.wfile = wfile
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.__pending = []
+        self.__pending_size = 0
+
+    def write(self, data):
+        self.__pending.append(data)
+        self.__pending_size += len(data)
+        self.length += len(data)
+        if self.__pending_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.__pending_size:
+            self.__pending.insert(0, '%x\r\n' % self.__pending_size)
+            self.__pending.append('\r\n')
+            self.wfile.write(''.join(self.__pending))
+            self.__pending = []
+            self.__pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.wfile.write('0\r\n\r\n')
+
+
+class Project:
+    """A database served below /name/ of the ENI port.
+
+    At most workers requests of a project run at the same time, so a busy
+    project leaves the others their share of the server.
+    """
+
+    def __init__(self, name, db, workers = 0):
+        self.name = name
+        self.db = db
+        self.workers = workers
+        self.slots = threading.Semaphore(workers) if workers > 0 else None
+        db.metric_labels = (('project', name),) if name else ()
+
+    @contextlib.contextmanager
+    def slot(self):
+        if self.slots is None:
+            yield
+            return
+        with self.slots:
+            yield
+
+
+def find_project(path):
+    """The Project a request path is for, None if there is no such project.
+
+    A first component of the path that names a project selects it, any
+    other path is for the project of --base, as before there were projects.
+    Without any projects, as when theni is embedded, requests go to the
+    global vcs.
+    """
+    name = urlparse.urlsplit(path).path.strip('/').split('/')[0]
+    project = projects.get(urllib.unquote(name))
+    if project is None:
+        project = projects.get('')
+    return project
+
+
+class EniRequest:
+    """One ENI request, from its XML body to the fragments of the response.
+
+    Independent of the HTTP front end that received it, which feeds the
+    body in pieces as they arrive. Without a project, the request goes to
+    the global vcs.
+    """
+
+    def __init__(self, project = None):
+        self.project = project
+        self.db = project.db if project is not None else vcs
+        self.start = time.time()
+        self.size = 0
+        self.command = 'unknown'
+        self.eni_command = 'unknown'
+        self.req = None
+        self.pending = False
+        self.__parser = ET.XMLParser(target=EniTreeBuilder())
+        self.__error = None
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.__error is None:
+            try:
+                self.__parser.feed(data)
+            except ET.ParseError, e:
+                # reported by run(), where the request is failed
+                self.__error = e
+
+    def run(self):
+        """Parse the request and run its command. Return False for XML that
+        is no ENI request at all."""
+        if not self.parse():
+            return False
+        if self.pending:
+            try:
+                with scheduler.slot(self.req.priority, self.req.user_name):
+                    self.execute()
+            except QueueFull, e:
+                self.refuse(e)
+        return True
+
+    def parse(self):
+        """Parse the request into self.req, its command pending if there is
+        one to run. Return False for XML that is no ENI request at all."""
+        metrics.observe('theni_request_bytes', self.size, buckets=SIZE_BUCKETS)
+
+        if self.__error is not None:
+            raise self.__error
+        req_etree = self.__parser.close()
+
+        if req_etree.tag == 'handshake':
+            self.command = EniHandshake.__name__
+            self.eni_command = 'handshake'
+            self.req = EniHandshake(req_etree)
+
+        elif req_etree.tag == 'request':
+            eni_cmd_name = req_etree.attrib['command']
+            self.eni_command = eni_cmd_name
+
+            logger.debug('eni command: %s', eni_cmd_name)
+            #logger.debug('xml xmlroot attrib: %s', req_etree.attrib)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('raw request: %s', ET.tostring(req_etree))
+
+            try:
+                clazz = globals()['EniCmd_%s' % eni_cmd_name.replace('-', '_')]
+                self.command = clazz.__name__
+                self.req = clazz(eni_cmd_name, req_etree)
+                self.req.vcs = self.db
+                self.pending = True
+
+            except KeyError:
+                self.req = EniError(eni_cmd_name, 16390, 'command "%s" not supported' % eni_cmd_name)
+                logger.error('Unsupported request command: %s', eni_cmd_name)
+                ET.dump(req_etree)
+
+            except EniError, e:
+                self.req = e
+
+            #except Exception, e:
+            #    req = EniError(eni_cmd_name, 2048, 'Unknown error')
+            #    print e
+
+        else:
+            logger.error('Unsupported ENI request: %s (neither "handshake" nor "request")', req_etree.tag)
+            return False
+        return True
+
+    def execute(self):
+        """Run the pending command, admitted by the scheduler. Only then
+        it takes a slot of its project, which a command waiting for its
+        class would keep from the others."""
+        self.pending = False
+        try:
+            if self.project is not None:
+                with self.project.slot():
+                    err = self.req.do()
+            else:
+                err = self.req.do()
+            if err:
+                self.req = err
+        except KeyError:
+            self.req = EniError(self.eni_command, 16390,
+                    'command "%s" not supported' % self.eni_command)
+            logger.error('Unsupported request command: %s', self.eni_command)
+        except EniError, e:
+            self.req = e
+
+    def refuse(self, e):
+        """Answer the pending command with busy, the scheduler refused it."""
+        self.pending = False
+        logger.warn('refused %s of %s: %s', self.eni_command, self.req.user_name, e)
+        self.req = EniError(self.eni_command, ERROR_BUSY, 'server busy, try again later')
+
+    def prefetch(self, connection):
+        """Start the prefetch of a connection after its first request that
+        opens a project; connection.prefetch keeps it."""
+        root = getattr(self.req, 'prefetch_root', None)
+        if root is not None and connection.prefetch is None:
+            connection.prefetch = self.db.prefetch(root, self.req.user_name) or False
+
+    def fragments(self):
+        return itertools.chain(
+                ['<?xml version="1.0" encoding="ISO-8859-1"?>\n'],
+                self.req.render())
+
+    def response(self):
+        return ''.join(map(encode_fragment, self.fragments()))
+
+    def done(self, rsp_len):
+        labels = (('command', self.command),)
+        metrics.inc('theni_requests_total', labels)
+        if isinstance(self.req, EniError):
+            metrics.inc('theni_request_errors_total', labels)
+        metrics.observe('theni_request_seconds', time.time() - self.start, labels)
+        metrics.observe('theni_response_bytes', rsp_len, labels, SIZE_BUCKETS)
+
+        logger.debug('=== OK ===')
+
+    def failed(self, e):
+        logger.error('EXCEPT %s', str(e))
+        metrics.inc('theni_request_failures_total', (('command', self.command),))
 
 
 class EniHandler(BaseHTTPRequestHandler):
@@ -822,78 +3283,534 @@ class EniHandler(BaseHTTPRequestHandler):
 
     protocol_version = 'HTTP/1.1'
     initialized = True
+    chunked = False
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        metrics.add('theni_active_connections', 1)
+        self.prefetch = None
+
+    def finish(self):
+        if self.prefetch:
+            self.prefetch.cancel()
+        metrics.add('theni_active_connections', -1)
+        BaseHTTPRequestHandler.finish(self)
 
     def do_POST(self):
-        try:
-            if EniHandler.initialized:
-                EniHandler.initialized = False
-                logger.debug('request_version: %s', self.request_version)
-                logger.debug('server_version: %s', self.server_version)
-                logger.debug('sys_version: %s', self.sys_version)
+        self.eni_request = None
+        profiler.call(self.handle_post,
+                lambda: self.eni_request.eni_command if self.eni_request else 'unknown')
+
+    def handle_post(self):
+        if EniHandler.initialized:
+            EniHandler.initialized = False
+            logger.debug('request_version: %s', self.request_version)
+            logger.debug('server_version: %s', self.server_version)
+            logger.debug('sys_version: %s', self.sys_version)
+
+        project = find_project(self.path)
+        if project is None and projects:
+            logger.error('no project for %s', self.path)
+            self.close_connection = 1
+            self.send_response(404)
+            self.send_header('content-length', 0)
+            self.end_headers()
+            return
 
-            content_len = int(self.headers.getheader('content-length'))
-            #logger.debug('content-length: %s', content_len)
-            content_rawxml = self.rfile.read(content_len)
+        content_len = int(self.headers.getheader('content-length'))
+        #logger.debug('content-length: %s', content_len)
+        eni = self.eni_request = EniRequest(project)
+        headers_sent = False
+        try:
+            while content_len > 0:
+                data = self.rfile.read(min(content_len, BLOCK_SIZE))
+                if not data:
+                    break
+                eni.feed(data)
+                content_len -= len(data)
+
+            if not eni.run():
+                self.send_response(500)
+                return
 
-            req_etree = ET.fromstring(content_rawxml)
+            if self.chunked and self.request_version == 'HTTP/1.1':
+                self.send_response(200)
+                self.send_header('transfer-encoding', 'chunked')
+                self.end_headers()
+                headers_sent = True
+                writer = ChunkedWriter(self.wfile)
+                for fragment in eni.fragments():
+                    writer.write(encode_fragment(fragment))
+                writer.close()
+                rsp_len = writer.length
+            else:
+                rsp_content_xml = eni.response()
+                self.send_response(200)
+                self.send_header('content-length', len(rsp_content_xml))
+                self.end_headers()
+                self.wfile.write(rsp_content_xml)
+                rsp_len = len(rsp_content_xml)
 
-            if req_etree.tag == 'handshake':
-                req = EniHandshake(req_etree)
+            eni.done(rsp_len)
+            eni.prefetch(self)
 
-            elif req_etree.tag == 'request':
-                eni_cmd_name = req_etree.attrib['command']
+        except Exception, e:
+            eni.failed(e)
+            if headers_sent:
+                # a status line now would end up inside the chunked body,
+                # the client sees the response cut short instead
+                self.close_connection = 1
+            else:
+                self.send_response(500)
+            raise
 
-                logger.debug('eni command: %s', eni_cmd_name)
-                #logger.debug('xml xmlroot attrib: %s', req_etree.attrib)
-                logger.debug('raw request: %s', content_rawxml)
 
-                try:
-                    clazz = globals()['EniCmd_%s' % eni_cmd_name.replace('-', '_')]
-                    req = clazz(eni_cmd_name, req_etree)
-                    err = req.do()
-                    if err:
-                        req = err
+class AdminHandler(BaseHTTPRequestHandler):
+    """Local HTTP endpoint for operators, separate from the ENI port."""
 
-                except KeyError:
-                    req = EniError(eni_cmd_name, 16390, 'command "%s" not supported' % eni_cmd_name)
-                    logger.error('Unsupported request command: %s', eni_cmd_name)
-                    ET.dump(req_etree)
+    def log_message(self, format, *args):
+        logger.debug('admin: %s - %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path == '/metrics':
+            self.send_text(metrics.render(), 'text/plain; version=0.0.4')
+        elif path == '/profile':
+            self.do_profile(urlparse.parse_qs(urlparse.urlsplit(self.path).query,
+                    keep_blank_values=True))
+        else:
+            self.send_error(404)
+
+    def do_profile(self, query):
+        """/profile?every=N, /profile?command=NAME, /profile?off"""
+        if 'every' in query:
+            profiler.configure(every=int(query['every'][0]))
+        elif 'command' in query:
+            profiler.configure(command=query['command'][0])
+        elif 'off' in query:
+            profiler.configure()
+        self.send_text('profiling %s\n' % profiler.status())
+
+    def send_text(self, text, content_type = 'text/plain'):
+        self.send_response(200)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', len(text))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Executor:
+    """A fixed number of worker threads running submitted calls in order.
+
+    With a size, at most size calls wait for a worker; submit raises
+    Queue.Full beyond that. resume queues calls admitted before, already
+    bounded by the scheduler, regardless of the size.
+    """
+
+    def __init__(self, workers, name = 'worker', size = 0):
+        self.workers = max(1, workers)
+        self.size = size
+        self.__queue = Queue.Queue()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__run, name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, f, *args):
+        if self.size and self.__queue.qsize() >= self.size:
+            raise Queue.Full
+        self.__queue.put((f, args))
+
+    def resume(self, f, *args):
+        self.__queue.put((f, args))
+
+    def __run(self):
+        while True:
+            f, args = self.__queue.get()
+            try:
+                f(*args)
+            except Exception:
+                logger.exception('worker failed')
+
+
+class EniConnection(asynchat.async_chat):
+    """One client connection of the AsyncEniServer.
+
+    Reads requests in the event loop and hands each one to a worker; the
+    connection does not read again until the response is sent. The loop
+    only spools the body, parsing and decoding it are left to the worker.
+    """
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.busy = False
+        self.last_active = time.time()
+        self.prefetch = None
+        self.__reset()
+        metrics.add('theni_active_connections', 1)
+
+    def __reset(self):
+        self.__buffer = []
+        self.__headers = None
+        self.__eni = None
+        self.__body = None
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.last_active = time.time()
+        if self.__body is not None:
+            self.__body.write(data)
+        else:
+            self.__buffer.append(data)
 
-                except EniError, e:
-                    req = e
+    def found_terminator(self):
+        if self.__headers is None:
+            data = ''.join(self.__buffer)
+            self.__buffer = []
+            self.__start(data)
+        else:
+            self.__request()
 
-                #except Exception, e:
-                #    req = EniError(eni_cmd_name, 2048, 'Unknown error')
-                #    print e
+    def __start(self, head):
+        lines = head.split('\r\n')
+        try:
+            method, path, self.version = lines[0].split()
+        except ValueError:
+            return self.__error(400)
+        self.__headers = dict((k.strip().lower(), v.strip())
+                for k, v in (line.split(':', 1) for line in lines[1:] if ':' in line))
+        if method != 'POST':
+            return self.__error(501)
+        try:
+            length = int(self.__headers.get('content-length', 0))
+        except ValueError:
+            return self.__error(400)
+        project = find_project(path)
+        if project is None and projects:
+            logger.error('no project for %s', path)
+            return self.__error(404)
+        self.__eni = EniRequest(project)
+        self.__body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        if length:
+            self.set_terminator(length)
+        else:
+            self.__request()
 
-            else:
-                logger.error('Unsupported ENI request: %s (neither "handshake" nor "request")', req_etree.tag)
-                self.send_response(500)
+    def __request(self):
+        connection = self.__headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        eni, body = self.__eni, self.__body
+        self.__reset()
+        self.busy = True
+        # no more reads until the response is out
+        self.set_terminator(None)
+        executor = self.server.executor(eni.project)
+        body.seek(0)
+        try:
+            executor.submit(self.__work, eni, body, executor)
+        except Queue.Full:
+            body.close()
+            logger.warn('refused a request, %s workers are busy', eni.project.name
+                    if eni.project is not None else 'all')
+            self.respond(503, '')
+
+    def __work(self, eni, body, executor):
+        """Runs in a worker thread. A command the scheduler does not admit
+        right away leaves the worker to others while it waits, and is
+        resumed on a worker once admitted."""
+        try:
+            try:
+                for data in iter(lambda: body.read(BLOCK_SIZE), ''):
+                    eni.feed(data)
+            finally:
+                body.close()
+            if not eni.parse():
+                self.server.reply(self, 500)
                 return
+            if eni.pending:
+                cls = eni.req.priority
+                try:
+                    if not scheduler.admit(cls, eni.req.user_name,
+                            lambda: executor.resume(self.__execute, eni, cls)):
+                        return
+                except QueueFull, e:
+                    eni.refuse(e)
+                else:
+                    return self.__execute(eni, cls)
+            self.__respond(eni)
+        except Exception, e:
+            self.__failed(eni, e)
 
-            rsp_content_xml = '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
-            rsp_content_xml += req.response().encode('ISO-8859-1')
-
-            self.send_response(200)
-            self.send_header('content-length', len(rsp_content_xml))
-            self.end_headers()
-            self.wfile.write(rsp_content_xml)
+    def __execute(self, eni, cls):
+        """Runs in a worker thread, with the command admitted."""
+        try:
+            try:
+                profiler.call(eni.execute, lambda: eni.eni_command)
+            finally:
+                scheduler.release(cls)
+            self.__respond(eni)
+        except Exception, e:
+            self.__failed(eni, e)
+
+    def __respond(self, eni):
+        content = eni.response()
+        eni.done(len(content))
+        eni.prefetch(self)
+        if self.prefetch and not self.connected:
+            # closed by the client meanwhile
+            self.prefetch.cancel()
+        self.server.reply(self, 200, content)
+
+    def __failed(self, eni, e):
+        eni.failed(e)
+        self.keep_alive = False
+        self.server.reply(self, 500)
+
+    def respond(self, code, content):
+        """Runs in the event loop, with the response of a worker."""
+        self.push(''.join([
+            '%s %d %s\r\n' % ('HTTP/1.1', code, BaseHTTPRequestHandler.responses[code][0]),
+            'Server: theni\r\n',
+            'Date: %s\r\n' % format_date_time(time.time()),
+            'content-length: %d\r\n' % len(content),
+            '' if self.keep_alive else 'connection: close\r\n',
+            '\r\n',
+            content,
+            ]))
+        self.busy = False
+        self.last_active = time.time()
+        if self.keep_alive:
+            self.set_terminator('\r\n\r\n')
+        else:
+            self.close_when_done()
+
+    def __error(self, code):
+        self.keep_alive = False
+        self.set_terminator(None)
+        self.respond(code, '')
+
+    def readable(self):
+        return not self.busy and asynchat.async_chat.readable(self)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.prefetch:
+            self.prefetch.cancel()
+        if self.server.connections.pop(id(self), None) is not None:
+            metrics.add('theni_active_connections', -1)
+        asynchat.async_chat.close(self)
+
+
+class AsyncEniServer(asyncore.dispatcher):
+    """ENI front end with one event loop for all client connections.
+
+    Connections cost no thread while idle; every request is run by one of
+    a bounded number of worker threads, the only ones to touch the
+    database. Every project has workers of its own, workers threads unless
+    the project says otherwise. Connections idle for longer than timeout
+    seconds are closed. sock is the listening socket, possibly shared with
+    other processes.
+    """
+
+    def __init__(self, sock, workers, timeout):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, sock, map=self.map)
+        self.accepting = True
+        self.timeout = timeout
+        self.workers = workers
+        self.__executors = {}   # project name -> Executor
+        self.connections = {}   # id -> EniConnection
+        self.__replies = Queue.Queue()
+        self.__wakeup_r, self.__wakeup_w = wakeup_pair()
+        waker = asyncore.dispatcher(self.__wakeup_r, self.map)
+        waker.handle_read = self.__handle_replies
+        waker.writable = lambda: False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            logger.debug('connection from %s:%s', *addr)
+            connection = EniConnection(sock, self)
+            self.connections[id(connection)] = connection
+
+    def executor(self, project):
+        """The Executor for the requests of project; runs in the event loop."""
+        name = project.name if project is not None else ''
+        executor = self.__executors.get(name)
+        if executor is None:
+            workers = project.workers if project is not None else 0
+            workers = workers or self.workers
+            executor = self.__executors[name] = Executor(workers,
+                    'eni-%s' % name if name else 'eni', workers * ASYNC_QUEUE_SIZE)
+        return executor
+
+    def reply(self, connection, code, content = ''):
+        """Hand a response to the event loop; called by the workers."""
+        self.__replies.put((connection, code, content))
+        try:
+            self.__wakeup_w.send('x')
+        except socket.error:
+            # full of wakeups the loop has not read yet
+            pass
 
-            logger.debug('=== OK ===')
+    def __handle_replies(self):
+        try:
+            self.__wakeup_r.recv(512)
+        except socket.error:
+            pass
+        while True:
+            try:
+                connection, code, content = self.__replies.get_nowait()
+            except Queue.Empty:
+                break
+            if connection.connected:
+                connection.respond(code, content)
+
+    def __expire(self):
+        deadline = time.time() - self.timeout
+        for connection in self.connections.values():
+            if not connection.busy and connection.last_active < deadline:
+                logger.debug('closing idle connection')
+                connection.close()
+
+    def serve_forever(self):
+        while True:
+            asyncore.loop(timeout=1.0, use_poll=True, map=self.map, count=1)
+            self.__expire()
+
+    def server_close(self):
+        self.close()
+
+
+def wakeup_pair():
+    """Return a connected pair of non-blocking sockets: socketpair where
+    there is one, loopback TCP elsewhere (nt)."""
+    if hasattr(socket, 'socketpair'):
+        r, w = socket.socketpair()
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            w = socket.create_connection(server.getsockname())
+            r, addr = server.accept()
+        finally:
+            server.close()
+    r.setblocking(False)
+    w.setblocking(False)
+    return r, w
+
+
+def listen(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(128)
+    return sock
+
+
+def prefork(processes, serve):
+    """Run serve(n) in processes forked workers, n counting from 0, and
+    restart the workers that exit until the supervisor is stopped."""
+    workers = {}
+    stopping = []
+
+    def spawn(n):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                serve(n)
+            except KeyboardInterrupt:
+                pass
+            except:
+                logger.exception('worker %d failed', n)
+                status = 1
+            os._exit(status)
+        logger.info('started worker %d, pid %d', n, pid)
+        workers[pid] = n
+
+    def stop(signum = None, frame = None):
+        stopping.append(True)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
 
-        except Exception, e:
-            logger.error('EXCEPT %s', str(e))
-            self.send_response(500)
-            raise
+    for n in range(processes):
+        spawn(n)
+    signal.signal(signal.SIGTERM, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            logger.warn('^C received, stopping workers')
+            stop()
+            continue
+        except OSError:
+            continue
+        n = workers.pop(pid, None)
+        if n is not None and not stopping:
+            logger.error('worker %d (pid %d) exited with status %d, restarting',
+                    n, pid, status)
+            # do not spin on a worker that fails right away
+            time.sleep(1)
+            spawn(n)
+
+
+def start_admin_server(port):
+    server = ThreadingHTTPServer(('localhost', port), AdminHandler)
+    thread = threading.Thread(target=server.serve_forever, name='admin')
+    thread.daemon = True
+    thread.start()
+    logger.info('started admin server on localhost, port %s', port)
+    return server
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'c:dD:hv', [
+        opts, args = getopt.getopt(sys.argv[1:], 'b:c:dD:g:hp:r:t:v', [
+            'admin-port=',
+            'async',
+            'async-log',
+            'base=',
+            'bulk-limit=',
+            'cache-size=',
+            'chunked',
             'config=',
             'debug',
             'db=',
+            'direct',
+            'group-commit=',
             'help',
+            'interactive-limit=',
+            'log-max-size=',
+            'log-rate=',
+            'log-sample=',
+            'max-history=',
+            'prefetch=',
+            'prefetch-budget=',
+            'processes=',
+            'profile-dir=',
+            'profile-every=',
+            'project=',
+            'queue-depth=',
+            'refresh=',
+            'state-dir=',
+            'threads=',
             'verbose',
             ])
     except getopt.GetoptError, err:
@@ -904,41 +3821,177 @@ def main():
 
     config = None
     xvcs = 'svn'
-    vcs_base = '../eni/'
+    vcs_base = None
+    project_dirs = []
+    threads = 0
+    refresh = 5
+    cache_size = 64
+    state_dir = '.theni'
+    max_history = 0
+    group_commit = 0
+    direct = False
+    admin_port = 0
+    profile_every = 1
+    async_server = False
+    processes = 1
+    async_log = False
+    prefetch = 0
+    prefetch_budget = 32
+    log_max_size = 4096
+    log_rate = 0
+    log_sample = 1
+    interactive_limit = 0
+    bulk_limit = 0
+    queue_depth = 0
 
     for o, a in opts:
-        if o in ('-c', '--config'):
+        if o == '--admin-port':
+            admin_port = int(a)
+        elif o == '--async':
+            async_server = True
+        elif o == '--async-log':
+            async_log = True
+        elif o in ('-b', '--base'):
+            vcs_base = a
+        elif o == '--bulk-limit':
+            bulk_limit = int(a)
+        elif o in ('-c', '--config'):
             config = a
+        elif o == '--cache-size':
+            cache_size = int(a)
+        elif o == '--chunked':
+            EniHandler.chunked = True
         elif o in ('-D', '--db'):
             xvcs = a.lower()
         elif o in ('-d', '--debug'):
             log_level = logging.DEBUG
+        elif o == '--direct':
+            direct = True
+        elif o in ('-g', '--group-commit'):
+            group_commit = float(a)
         elif o in ('-h', '--help'):
             sys.exit(__doc__)
+        elif o == '--interactive-limit':
+            interactive_limit = int(a)
+        elif o == '--log-max-size':
+            log_max_size = int(a)
+        elif o == '--log-rate':
+            log_rate = int(a)
+        elif o == '--log-sample':
+            log_sample = int(a)
+        elif o == '--max-history':
+            max_history = int(a)
+        elif o == '--prefetch':
+            prefetch = int(a)
+        elif o == '--prefetch-budget':
+            prefetch_budget = int(a)
+        elif o in ('-p', '--processes'):
+            processes = int(a)
+        elif o == '--profile-dir':
+            profiler.directory = a
+        elif o == '--profile-every':
+            profile_every = int(a)
+        elif o == '--project':
+            name, sep, value = a.partition('=')
+            project_dirs.append((name, value if sep else None))
+        elif o == '--queue-depth':
+            queue_depth = int(a)
+        elif o == '--state-dir':
+            state_dir = a
+        elif o in ('-r', '--refresh'):
+            refresh = float(a)
+        elif o in ('-t', '--threads'):
+            threads = int(a)
         elif o in ('-v', '--verbose'):
             log_level = logging.INFO
         else:
             sys.exit('Unhandled command line option: %s' % o)
 
     logger.setLevel(log_level)
+    scheduler.configure(interactive_limit, bulk_limit, queue_depth)
+
+    if config is not None:
+        parser = ConfigParser()
+        parser.optionxform = str    # project names are case sensitive
+        if not parser.read(config):
+            sys.exit('Cannot read %s' % config)
+        if parser.has_section('projects'):
+            project_dirs.extend(parser.items('projects', raw=True))
+    project_list = []
+    for name, value in project_dirs:
+        if not name or '/' in name or value is None:
+            sys.exit('Bad project: %s' % name)
+        base, sep, workers = value.partition(',')
+        project_list.append((name, base.strip(), int(workers) if sep else threads))
+    if vcs_base is None and not project_list:
+        vcs_base = '../eni/'
+
+    if xvcs not in ('svn', 'cas'):
+        sys.exit('Unknown database: %s' % xvcs)
+    if processes > 1 and (not hasattr(os, 'fork') or fcntl is None):
+        sys.exit('--processes needs fork and flock, which this platform lacks')
+    if processes > 1 and xvcs != 'svn':
+        sys.exit('Only the svn database can be shared by several processes')
+
+    def open_db(base, name = ''):
+        if xvcs == 'svn':
+            # every project keeps its metadata in a directory of its own
+            db = SvnDB(base, clients=threads, cache_size=cache_size << 20,
+                    state_dir=os.path.join(state_dir, name) if state_dir and name else state_dir,
+                    max_history=max_history, group_commit=group_commit,
+                    direct=direct, shared_wc=processes > 1,
+                    prefetch_workers=prefetch, prefetch_budget=prefetch_budget << 20)
+            if refresh > 0:
+                db.start_refresh(refresh)
+        elif xvcs == 'cas':
+            db = CasDB(base, max_history=max_history)
+        for object_type in OBJECT_TYPES:
+            db.add_object_type_info(*object_type)
+        db.watch_config(CONFIG_CHECK_INTERVAL)
+        return db
 
-    if xvcs == 'svn':
+    def open_projects():
         global vcs
-        vcs = SvnDB(vcs_base)
-        for object_type in OBJECT_TYPES:
-            vcs.add_object_type_info(*object_type)
-    else:
-        sys.exit('Unknown database: %s' % vcs)
+        if vcs_base is not None:
+            vcs = open_db(vcs_base)
+            projects[''] = Project('', vcs, threads)
+        for name, base, workers in project_list:
+            logger.info('project "%s" on "%s", %d workers', name, base, workers)
+            projects[name] = Project(name, open_db(base, name), workers)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle(profile_every))
 
     HOST, PORT = 'localhost', 80
-    server = HTTPServer((HOST, PORT), EniHandler)
+    sock = listen((HOST, PORT))
     logger.info('started theni server on %s, port %s', HOST, PORT)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        logger.warn('^C received, shutting down theni server')
-    finally:
-        server.socket.close()
+
+    def serve(n = 0):
+        # in every worker, the log thread does not survive a fork
+        setup_logging(async_log, log_rate, log_sample, log_max_size)
+        open_projects()
+        # the admin port shows the first worker
+        if admin_port and n == 0:
+            start_admin_server(admin_port)
+        if async_server:
+            server = AsyncEniServer(sock, threads, SERVER_SETTINGS['comm-timeout'])
+        else:
+            server_class = ThreadingHTTPServer if threads > 0 else HTTPServer
+            server = server_class((HOST, PORT), EniHandler, bind_and_activate=False)
+            server.socket.close()
+            server.socket = sock
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            if n == 0 and processes <= 1:
+                logger.warn('^C received, shutting down theni server')
+        finally:
+            server.socket.close()
+
+    if processes > 1:
+        prefork(processes, serve)
+    else:
+        serve()
 
 
 if __name__ == '__main__':